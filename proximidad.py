@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Índice de proximidad parcela – vegetación propuesta
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+
+# ETRS89 / UTM 30N (Navarra): distancias y áreas en metros
+CRS_METRICO = 25830
+RADIOS_PROXIMIDAD = (50, 100, 200)
+
+# Escenario → filtro de la vegetación propuesta (igual que en el visor)
+ESCENARIOS_VEGETACION = ("Ideal", "Prioritario")
+
+
+def columna_distancia(escenario):
+    return f"Distancia a la zona verde más cercana – {escenario} (m)"
+
+
+def columna_arboles(escenario, radio):
+    return f"Árboles propuestos a {radio} m – {escenario}"
+
+
+def columna_area(escenario, radio):
+    return f"Área verde propuesta a {radio} m – {escenario} (m²)"
+
+
+def _filtrar(capa, escenario):
+    if escenario == "Prioritario" and "Prioridad" in capa.columns:
+        return capa[capa["Prioridad"].astype(str) == "1"]
+    return capa
+
+
+def _geometrias(capa):
+    geoms = capa.geometry.values
+    return np.asarray(geoms[~(capa.geometry.isna() | capa.geometry.is_empty).to_numpy()])
+
+
+def indice_proximidad(parcelas, zonas, arboles, crs=CRS_METRICO, radios=RADIOS_PROXIMIDAD):
+    """
+    Métricas de exposición a la vegetación propuesta por parcela.
+
+    Todo se calcula una vez en un CRS proyectado con un STRtree por capa:
+    una consulta `dwithin` al radio máximo da los pares parcela–elemento
+    candidatos, y los radios menores se resuelven filtrando esos pares por
+    distancia. Para cada escenario (Ideal: toda la vegetación; Prioritario:
+    `Prioridad == "1"`) se devuelve la distancia a la zona verde más cercana,
+    el número de árboles y el área verde dentro de cada radio. El área suma
+    las intersecciones de cada zona con el buffer de la parcela, de modo que
+    zonas verdes solapadas se cuentan dos veces.
+    """
+    radios = sorted(radios)
+    radio_max = radios[-1]
+
+    geoms = np.asarray(parcelas.to_crs(epsg=crs).geometry.values)
+    n = len(geoms)
+
+    zonas = zonas.to_crs(epsg=crs)
+    arboles = arboles.to_crs(epsg=crs)
+
+    columnas = {}
+
+    for escenario in ESCENARIOS_VEGETACION:
+        geoms_zonas = _geometrias(_filtrar(zonas, escenario))
+        geoms_arboles = _geometrias(_filtrar(arboles, escenario))
+
+        # =========================
+        # DISTANCIA A LA ZONA VERDE MÁS CERCANA
+        # =========================
+        distancia = np.full(n, np.nan)
+        if len(geoms_zonas):
+            arbol_zonas = STRtree(geoms_zonas)
+            (i_parcela, _), d = arbol_zonas.query_nearest(
+                geoms, return_distance=True, all_matches=False
+            )
+            distancia[i_parcela] = d
+
+            # Pares parcela–zona dentro del radio máximo
+            i_par, j_zona = arbol_zonas.query(geoms, predicate="dwithin", distance=radio_max)
+            d_zonas = shapely.distance(geoms[i_par], geoms_zonas[j_zona])
+        else:
+            i_par = j_zona = np.array([], dtype=int)
+            d_zonas = np.array([])
+
+        columnas[columna_distancia(escenario)] = distancia
+
+        # =========================
+        # ÁRBOLES DENTRO DE CADA RADIO
+        # =========================
+        if len(geoms_arboles):
+            i_arb, j_arb = STRtree(geoms_arboles).query(
+                geoms, predicate="dwithin", distance=radio_max
+            )
+            d_arboles = shapely.distance(geoms[i_arb], geoms_arboles[j_arb])
+        else:
+            i_arb = np.array([], dtype=int)
+            d_arboles = np.array([])
+
+        for radio in radios:
+            dentro = d_arboles <= radio
+            columnas[columna_arboles(escenario, radio)] = np.bincount(
+                i_arb[dentro], minlength=n
+            )
+
+        # =========================
+        # ÁREA VERDE DENTRO DE CADA RADIO
+        # =========================
+        for radio in radios:
+            dentro = d_zonas <= radio
+            area = np.zeros(n)
+            if dentro.any():
+                # Un buffer por parcela implicada, reutilizado en todos sus pares
+                implicadas = np.unique(i_par[dentro])
+                buffers = np.empty(n, dtype=object)
+                buffers[implicadas] = shapely.buffer(geoms[implicadas], radio)
+                interseccion = shapely.area(
+                    shapely.intersection(buffers[i_par[dentro]], geoms_zonas[j_zona[dentro]])
+                )
+                area = np.bincount(i_par[dentro], weights=interseccion, minlength=n)
+            columnas[columna_area(escenario, radio)] = area
+
+    return pd.DataFrame(columnas, index=parcelas.index)
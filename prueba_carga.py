@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga – sesiones simultáneas contra un servidor real del visor
+
+Arranca `streamlit run visor_demo.py` (o usa uno ya arrancado con --url) y
+abre N clientes sin navegador que hablan el protocolo de Streamlit por
+websocket, igual que el frontend: cada uno pide un rerun con el estado de
+sus widgets y espera al fin del script. Las sesiones corren en paralelo en
+el servidor, con sus hilos, cachés, registro compartido y GIL reales.
+
+Cada sesión cambia de modo, escenario, variable y estación al azar y envía
+clics en el mapa (valor del componente st_folium). Con --escalones se repite
+la prueba con distintos números de sesiones y se informa de la capacidad:
+el mayor número de sesiones cuyo p95 de latencia no supera --objetivo-p95
+sin sesiones abandonadas (los reruns que acaban en excepción del script se
+cuentan aparte como errores).
+La memoria y la CPU son las del proceso del servidor.
+
+Uso:
+    python prueba_carga.py --escalones 5,10,20,40 --pasos 20 --pausa 0.5
+    python prueba_carga.py --url http://localhost:8501 --pid 12345 --sesiones 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+import websockets
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.Radio_pb2 import Radio
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(BASE_DIR, "visor_demo.py")
+
+PUERTO = 8599
+
+# Tiempo máximo (s) de un rerun antes de darlo por fallido
+TIMEOUT_RERUN = 300
+
+# Tiempo máximo (s) para que el servidor arranque
+TIMEOUT_ARRANQUE = 60
+
+# Tamaño máximo de un mensaje del servidor (los mapas van en el HTML)
+MAX_MENSAJE = 512 * 1024 ** 2
+
+PERCENTILES = (50, 90, 95, 99)
+
+# Streamlit reciente identifica la opción elegida por su texto; antes, por su índice
+OPCION_POR_TEXTO = "raw_value" in Radio.DESCRIPTOR.fields_by_name
+
+# Acción → peso en el recorrido aleatorio de cada sesión
+ACCIONES = {
+    "modo": 0.15,
+    "escenario": 0.25,
+    "variable": 0.20,
+    "estacion": 0.25,
+    "click": 0.15,
+}
+
+ETIQUETA_MODO = "Selecciona modo"
+
+# Etiquetas de los widgets de la barra lateral que toca cada acción
+WIDGETS = {
+    "modo": [ETIQUETA_MODO],
+    "escenario": ["Escenario", "Escenario A", "Escenario B"],
+    "variable": ["Variable", "Variable demográfica / catastral"],
+    "estacion": ["Estación"],
+}
+
+# Centro aproximado de la Rochapea y desplazamiento máximo (grados) del clic
+CENTRO_CLICK = (42.8255, -1.6500)
+DISPERSION_CLICK = 0.003
+
+
+# =========================
+# SERVIDOR
+# =========================
+def arrancar_servidor(puerto):
+    """Lanza `streamlit run` sin navegador y espera a que responda."""
+    proceso = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", SCRIPT_PATH,
+            "--server.headless", "true",
+            "--server.port", str(puerto),
+            "--browser.gatherUsageStats", "false",
+        ],
+        cwd=BASE_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    url = f"http://localhost:{puerto}"
+    limite = time.monotonic() + TIMEOUT_ARRANQUE
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError("El servidor de Streamlit no ha arrancado")
+        try:
+            with urllib.request.urlopen(f"{url}/_stcore/health", timeout=1) as respuesta:
+                if respuesta.status == 200:
+                    return proceso, url
+        except OSError:
+            time.sleep(0.5)
+    proceso.terminate()
+    raise RuntimeError("El servidor de Streamlit no responde")
+
+
+def memoria_rss(pid):
+    """RSS actual del proceso en bytes."""
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def tiempo_cpu(pid):
+    """Segundos de CPU (usuario + sistema) consumidos por el proceso."""
+    with open(f"/proc/{pid}/stat") as f:
+        # El nombre del proceso va entre paréntesis y puede contener espacios
+        campos = f.read().rsplit(")", 1)[1].split()
+    return (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")
+
+
+# =========================
+# CLIENTE SIN NAVEGADOR
+# =========================
+class Sesion:
+    """
+    Una sesión del visor vista desde el cliente.
+
+    Guarda los widgets de la última ejecución y el valor que la sesión ha
+    elegido para cada uno; en cada rerun se envían todos, como hace el
+    frontend, para que el servidor no los devuelva a su valor por defecto.
+    """
+
+    def __init__(self, indice, url, semilla):
+        self.indice = indice
+        self.url = url.replace("http", "ws", 1).rstrip("/") + "/_stcore/stream"
+        self.rng = random.Random(semilla * 100003 + indice)
+        self.ws = None
+        self.pagina = ""
+        self.widgets = {}
+        self.valores = {}
+        self.mapa = None
+        self.cache = {}
+        self.medidas = []
+
+    async def conectar(self):
+        self.ws = await websockets.connect(self.url, max_size=MAX_MENSAJE)
+
+    async def cerrar(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+    def _mensaje(self, click=None):
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        msg.rerun_script.page_script_hash = self.pagina
+        estados = msg.rerun_script.widget_states.widgets
+        for id_widget, (campo, valor) in self.valores.items():
+            estado = estados.add()
+            estado.id = id_widget
+            setattr(estado, campo, valor)
+        if click is not None and self.mapa is not None:
+            estado = estados.add()
+            estado.id = self.mapa
+            estado.json_value = json.dumps({"last_clicked": click})
+        return msg.SerializeToString()
+
+    def _leer_elemento(self, elemento, widgets):
+        tipo = elemento.WhichOneof("type")
+        if tipo in ("radio", "selectbox"):
+            widget = getattr(elemento, tipo)
+            widgets[widget.label] = (widget.id, list(widget.options))
+        elif tipo == "component_instance" and "folium" in elemento.component_instance.component_name:
+            self.mapa = elemento.component_instance.id
+        return tipo == "exception"
+
+    async def rerun(self, accion, click=None):
+        """Pide un rerun y espera a que el script termine (incluidos sus st.rerun)."""
+        inicio = time.perf_counter()
+        await self.ws.send(self._mensaje(click))
+
+        widgets, error = {}, False
+        self.mapa = None
+        while True:
+            crudo = await asyncio.wait_for(self.ws.recv(), TIMEOUT_RERUN)
+            msg = ForwardMsg()
+            msg.ParseFromString(crudo)
+            if msg.hash:
+                self.cache[msg.hash] = msg
+            if msg.WhichOneof("type") == "ref_hash":
+                msg = self.cache.get(msg.ref_hash, msg)
+
+            tipo = msg.WhichOneof("type")
+            if tipo == "new_session":
+                self.pagina = msg.new_session.page_script_hash
+            elif tipo == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                error |= self._leer_elemento(msg.delta.new_element, widgets)
+            elif tipo == "script_finished":
+                if msg.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    # El visor relanza el script mientras hay capas en carga
+                    widgets, error = {}, False
+                    self.mapa = None
+                    continue
+                error |= msg.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR
+                break
+
+        self.widgets = widgets
+        ids = {id_widget for id_widget, _ in widgets.values()}
+        self.valores = {k: v for k, v in self.valores.items() if k in ids}
+        self.medidas.append((accion, time.perf_counter() - inicio, error))
+
+    def elegir(self, etiqueta, opcion):
+        """Fija el valor de un radio/selectbox de la última ejecución."""
+        id_widget, opciones = self.widgets[etiqueta]
+        if OPCION_POR_TEXTO:
+            self.valores[id_widget] = ("string_value", opciones[opcion])
+        else:
+            self.valores[id_widget] = ("int_value", opcion)
+
+    def accion_aleatoria(self):
+        """Cambia un widget al azar (o prepara un clic); devuelve (acción, clic)."""
+        accion = self.rng.choices(list(ACCIONES), weights=list(ACCIONES.values()))[0]
+
+        if accion == "click":
+            if self.mapa is not None:
+                lat, lon = CENTRO_CLICK
+                return accion, {
+                    "lat": lat + self.rng.uniform(-DISPERSION_CLICK, DISPERSION_CLICK),
+                    "lng": lon + self.rng.uniform(-DISPERSION_CLICK, DISPERSION_CLICK),
+                }
+            # El modo actual no tiene mapa de folium: se cambia de modo
+            accion = "modo"
+
+        candidatos = [e for e in WIDGETS[accion] if e in self.widgets]
+        if not candidatos:
+            # El modo actual no tiene ese widget: se cambia de modo
+            accion = "modo"
+            candidatos = WIDGETS[accion]
+
+        etiqueta = self.rng.choice(candidatos)
+        self.elegir(etiqueta, self.rng.randrange(len(self.widgets[etiqueta][1])))
+        return accion, None
+
+
+async def ejecutar_sesion(sesion, pasos, pausa, retraso):
+    await asyncio.sleep(retraso)
+    await sesion.conectar()
+    await sesion.rerun("inicio")
+    for _ in range(pasos):
+        if pausa:
+            await asyncio.sleep(sesion.rng.uniform(0, 2 * pausa))
+        accion, click = sesion.accion_aleatoria()
+        await sesion.rerun(accion, click)
+
+
+async def calentar(url):
+    """
+    Recorre todos los modos en una sesión para llenar las cachés compartidas.
+
+    Devuelve la duración del primer rerun (arranque en frío) y el número de
+    reruns con error.
+    """
+    sesion = Sesion(-1, url, 0)
+    await sesion.conectar()
+    try:
+        await sesion.rerun("inicio")
+        for opcion in range(len(sesion.widgets[ETIQUETA_MODO][1])):
+            sesion.elegir(ETIQUETA_MODO, opcion)
+            await sesion.rerun("calentamiento")
+    finally:
+        await sesion.cerrar()
+    return sesion.medidas[0][1], sum(1 for *_, error in sesion.medidas if error)
+
+
+def _percentiles(latencias):
+    if not latencias:
+        return {}
+    valores = np.percentile(latencias, PERCENTILES)
+    resumen = {f"p{p}": float(v) for p, v in zip(PERCENTILES, valores)}
+    resumen["media"] = float(np.mean(latencias))
+    resumen["max"] = float(np.max(latencias))
+    resumen["n"] = len(latencias)
+    return resumen
+
+
+async def escalon(url, pid, sesiones, pasos, pausa, rampa, semilla, espera_cierre):
+    """N sesiones simultáneas contra el servidor; devuelve sus medidas."""
+    rss_base = memoria_rss(pid)
+    cpu_inicial = tiempo_cpu(pid)
+    inicio = time.perf_counter()
+
+    activas = [Sesion(i, url, semilla) for i in range(sesiones)]
+    resultados = await asyncio.gather(
+        *(
+            ejecutar_sesion(s, pasos, pausa, i * rampa / sesiones)
+            for i, s in enumerate(activas)
+        ),
+        return_exceptions=True
+    )
+
+    duracion = time.perf_counter() - inicio
+    cpu = tiempo_cpu(pid) - cpu_inicial
+
+    # Memoria con todas las sesiones abiertas y tras cerrarlas: la diferencia
+    # es el estado de las sesiones; lo que queda sobre la base, cachés nuevas
+    rss_con_sesiones = memoria_rss(pid)
+    await asyncio.gather(*(s.cerrar() for s in activas))
+    await asyncio.sleep(espera_cierre)
+    rss_sin_sesiones = memoria_rss(pid)
+
+    fallidas = {
+        str(i): f"{type(r).__name__}: {r}"
+        for i, r in enumerate(resultados) if isinstance(r, BaseException)
+    }
+    medidas = [m for s in activas for m in s.medidas]
+    por_accion = {}
+    for accion, latencia, _ in medidas:
+        por_accion.setdefault(accion, []).append(latencia)
+
+    return {
+        "sesiones": sesiones,
+        "sesiones_completadas": sesiones - len(fallidas),
+        "sesiones_fallidas": fallidas,
+        "duracion_s": duracion,
+        "reruns": len(medidas),
+        "reruns_por_s": len(medidas) / duracion if duracion else 0.0,
+        "errores": sum(1 for *_, error in medidas if error),
+        "latencia_s": _percentiles([latencia for _, latencia, _ in medidas]),
+        "latencia_por_accion_s": {a: _percentiles(v) for a, v in sorted(por_accion.items())},
+        "memoria": {
+            "rss_inicial_mb": rss_base / 1024 ** 2,
+            "rss_con_sesiones_mb": rss_con_sesiones / 1024 ** 2,
+            "rss_sin_sesiones_mb": rss_sin_sesiones / 1024 ** 2,
+            "crecimiento_caches_mb": (rss_sin_sesiones - rss_base) / 1024 ** 2,
+            "por_sesion_mb": (rss_con_sesiones - rss_sin_sesiones) / max(sesiones, 1) / 1024 ** 2,
+        },
+        "cpu": {
+            "segundos": cpu,
+            "utilizacion": cpu / duracion if duracion else 0.0,
+        },
+    }
+
+
+def prueba_carga(
+    escalones=(10,),
+    pasos=20,
+    pausa=0.5,
+    rampa=0.0,
+    semilla=0,
+    objetivo_p95=2.0,
+    url=None,
+    pid=None,
+    puerto=PUERTO,
+    espera_cierre=2.0
+):
+    """Lanza los escalones contra el servidor y devuelve el informe como diccionario."""
+    proceso = None
+    if url is None:
+        proceso, url = arrancar_servidor(puerto)
+        pid = proceso.pid
+    if pid is None:
+        raise ValueError("Con --url hay que indicar --pid del servidor para medir memoria y CPU")
+
+    try:
+        rss_inicial = memoria_rss(pid)
+        arranque_frio, errores_calentamiento = asyncio.run(calentar(url))
+        rss_caliente = memoria_rss(pid)
+
+        resultados = [
+            asyncio.run(escalon(url, pid, n, pasos, pausa, rampa, semilla, espera_cierre))
+            for n in escalones
+        ]
+    finally:
+        if proceso is not None:
+            proceso.terminate()
+            proceso.wait()
+
+    capacidad = max(
+        (
+            r["sesiones"] for r in resultados
+            if not r["sesiones_fallidas"] and r["latencia_s"] and r["latencia_s"]["p95"] <= objetivo_p95
+        ),
+        default=0
+    )
+
+    return {
+        "pasos": pasos,
+        "pausa_s": pausa,
+        "objetivo_p95_s": objetivo_p95,
+        "capacidad_sesiones": capacidad,
+        "arranque_frio_s": arranque_frio,
+        "errores_calentamiento": errores_calentamiento,
+        "rss_inicial_mb": rss_inicial / 1024 ** 2,
+        "rss_tras_calentamiento_mb": rss_caliente / 1024 ** 2,
+        "nucleos": os.cpu_count(),
+        "escalones": resultados,
+    }
+
+
+# =========================
+# INFORME
+# =========================
+def _fila(nombre, p):
+    return (
+        f"{nombre:<12} {p['n']:>6} {p['media']:>8.3f} "
+        + " ".join(f"{p[f'p{q}']:>8.3f}" for q in PERCENTILES)
+        + f" {p['max']:>8.3f}"
+    )
+
+
+def imprimir_informe(informe):
+    print(f"Pasos por sesión: {informe['pasos']} · pausa media: {informe['pausa_s']} s")
+    print(f"Arranque en frío: {informe['arranque_frio_s']:.2f} s · "
+          f"errores en el calentamiento: {informe['errores_calentamiento']}")
+    print(f"Memoria RSS del servidor: {informe['rss_inicial_mb']:.0f} MB al arrancar → "
+          f"{informe['rss_tras_calentamiento_mb']:.0f} MB en caliente")
+
+    cabecera = f"{'acción':<12} {'n':>6} {'media':>8} " + " ".join(
+        f"{'p' + str(q):>8}" for q in PERCENTILES
+    ) + f" {'max':>8}"
+
+    for r in informe["escalones"]:
+        print()
+        print(f"== {r['sesiones']} sesiones simultáneas ==")
+        print(f"Completadas: {r['sesiones_completadas']}/{r['sesiones']} · "
+              f"duración: {r['duracion_s']:.1f} s · reruns: {r['reruns']} "
+              f"({r['reruns_por_s']:.2f}/s) · errores: {r['errores']}")
+        for i, error in r["sesiones_fallidas"].items():
+            print(f"Sesión {i} abandonada: {error}")
+
+        print("Latencia de rerun (s)")
+        print(cabecera)
+        if r["latencia_s"]:
+            print(_fila("todas", r["latencia_s"]))
+        for accion, p in r["latencia_por_accion_s"].items():
+            print(_fila(accion, p))
+
+        memoria = r["memoria"]
+        print(f"Memoria RSS: {memoria['rss_con_sesiones_mb']:.0f} MB con sesiones · "
+              f"{memoria['por_sesion_mb']:.1f} MB por sesión · "
+              f"{memoria['crecimiento_caches_mb']:.0f} MB de cachés nuevas")
+        cpu = r["cpu"]
+        print(f"CPU del servidor: {cpu['segundos']:.1f} s ({cpu['utilizacion'] * 100:.0f} % de un núcleo, "
+              f"{informe['nucleos']} núcleos disponibles)")
+
+    print()
+    print(f"Capacidad con p95 ≤ {informe['objetivo_p95_s']} s sin sesiones abandonadas: "
+          f"{informe['capacidad_sesiones']} sesiones simultáneas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del visor")
+    parser.add_argument("--sesiones", type=int, default=10, help="Sesiones simultáneas")
+    parser.add_argument("--escalones", default=None,
+                        help="Números de sesiones a probar, p. ej. 5,10,20 (sustituye a --sesiones)")
+    parser.add_argument("--pasos", type=int, default=20, help="Interacciones por sesión")
+    parser.add_argument("--pausa", type=float, default=0.5, help="Pausa media entre interacciones (s)")
+    parser.add_argument("--rampa", type=float, default=0.0, help="Tiempo para arrancar todas las sesiones (s)")
+    parser.add_argument("--objetivo-p95", type=float, default=2.0, help="Latencia p95 aceptable (s)")
+    parser.add_argument("--url", default=None, help="Servidor ya arrancado (por defecto se lanza uno)")
+    parser.add_argument("--pid", type=int, default=None, help="PID del servidor indicado con --url")
+    parser.add_argument("--puerto", type=int, default=PUERTO, help="Puerto del servidor que se lanza")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", default=None, help="Guarda el informe en JSON")
+    args = parser.parse_args()
+
+    escalones = (
+        [int(n) for n in args.escalones.split(",") if n]
+        if args.escalones else [args.sesiones]
+    )
+
+    informe = prueba_carga(
+        escalones=escalones,
+        pasos=args.pasos,
+        pausa=args.pausa,
+        rampa=args.rampa,
+        semilla=args.semilla,
+        objetivo_p95=args.objetivo_p95,
+        url=args.url,
+        pid=args.pid,
+        puerto=args.puerto
+    )
+    imprimir_informe(informe)
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,643 @@
+# -*- coding: utf-8 -*-
+"""
+Registro de distritos – configuración, carga bajo demanda y expulsión LRU
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import rasterio.warp
+import shapely
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+
+
+MAP_CRS = 4326
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(BASE_DIR, "distritos.json")
+USO_PATH = os.path.join(BASE_DIR, ".distritos_uso.json")
+
+# Bytes aproximados por vértice (x, y en float64)
+BYTES_POR_COORDENADA = 16
+
+# Hilos para leer capas en paralelo (parcelas, vegetación y rasters)
+MAX_HILOS_CARGA = 6
+
+# Intervalo por defecto (s) entre comprobaciones de ficheros modificados
+VIGILAR_CADA = 5.0
+
+# Espera (s) antes de reintentar una capa que no se pudo leer; se duplica en
+# cada intento hasta ESPERA_REINTENTO_MAX
+ESPERA_REINTENTO = 2.0
+ESPERA_REINTENTO_MAX = 300.0
+
+# Ficheros auxiliares de un shapefile que forman parte de su contenido
+EXTENSIONES_SHAPEFILE = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+logger = logging.getLogger(__name__)
+
+
+# =========================
+# CONFIGURACIÓN
+# =========================
+def _ruta(base, path):
+    if path is None:
+        return None
+    return path if os.path.isabs(path) else os.path.join(base, path)
+
+
+def cargar_config(path=CONFIG_PATH):
+    """
+    Lee el fichero de distritos y resuelve las rutas respecto a su carpeta.
+
+    Cada distrito declara su capa de parcelas (`path` + `layer`), las capas de
+    vegetación propuesta, los rasters ICC por estación, el CRS métrico para
+    distancias (`crs_metrico`) y un mapeo `columnas`
+    {columna del fichero: columna esperada por el visor}.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(path))
+    for distrito in config["distritos"].values():
+        distrito["parcelas"]["path"] = _ruta(base, distrito["parcelas"]["path"])
+        distrito["zonas_verdes"] = _ruta(base, distrito.get("zonas_verdes"))
+        distrito["arboles"] = _ruta(base, distrito.get("arboles"))
+        distrito["icc_rasters"] = {
+            estacion: _ruta(base, p)
+            for estacion, p in distrito.get("icc_rasters", {}).items()
+        }
+        distrito.setdefault("columnas", {})
+
+    return config
+
+
+# =========================
+# CARGA DE DATOS
+# =========================
+def load_data(distrito):
+    parcelas = distrito["parcelas"]
+    # El índice es el fid del fichero: identificador estable de cada parcela
+    gdf = gpd.read_file(parcelas["path"], layer=parcelas.get("layer"), fid_as_index=True)
+    return gdf.rename(columns=distrito["columnas"]).to_crs(epsg=MAP_CRS)
+
+
+def _capa_vegetacion(path):
+    if path is None:
+        return gpd.GeoDataFrame({"Prioridad": []}, geometry=[], crs=f"EPSG:{MAP_CRS}")
+    return gpd.read_file(path).to_crs(epsg=MAP_CRS)
+
+
+def load_icc_raster(raster_path):
+    """Banda 1 del raster ICC en su CRS original, para leer valores puntuales."""
+    with rasterio.open(raster_path) as src:
+        data = src.read(1)
+        transform = src.transform
+        crs = src.crs
+        height = src.height
+        width = src.width
+    return data, transform, crs, height, width
+
+
+def sample_icc_raster(raster, lons, lats):
+    """Valores del raster (ver `load_icc_raster`) en arrays de lon/lat; NaN fuera o sin dato."""
+    data, transform, crs, height, width = raster
+
+    xs, ys = rasterio.warp.transform(f"EPSG:{MAP_CRS}", crs, list(lons), list(lats))
+    rows, cols = rasterio.transform.rowcol(transform, xs, ys)
+    rows = np.atleast_1d(np.asarray(rows, dtype=int))
+    cols = np.atleast_1d(np.asarray(cols, dtype=int))
+
+    dentro = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    valores = np.full(rows.shape, np.nan, dtype=float)
+    valores[dentro] = data[rows[dentro], cols[dentro]]
+    valores[~np.isfinite(valores)] = np.nan
+    return valores
+
+
+def reproject_icc_raster(raster_path):
+    """Raster ICC reproyectado a EPSG:4326 y sus límites en formato folium."""
+    with rasterio.open(raster_path) as src:
+
+        dst_crs = f"EPSG:{MAP_CRS}"
+
+        transform, width, height = calculate_default_transform(
+            src.crs,
+            dst_crs,
+            src.width,
+            src.height,
+            *src.bounds
+        )
+
+        data = np.empty((height, width), dtype=np.float32)
+
+        reproject(
+            source=rasterio.band(src, 1),
+            destination=data,
+            src_transform=src.transform,
+            src_crs=src.crs,
+            dst_transform=transform,
+            dst_crs=dst_crs,
+            resampling=Resampling.bilinear
+        )
+
+    bounds = rasterio.transform.array_bounds(
+        height, width, transform
+    )
+
+    folium_bounds = [
+        [bounds[1], bounds[0]],  # south, west
+        [bounds[3], bounds[2]]   # north, east
+    ]
+
+    return data, folium_bounds
+
+
+def leer_icc_raster(raster_path):
+    """
+    Capa `icc:<estación>` del registro: (datos reproyectados, límites folium, original).
+
+    `original` es la banda en su CRS (ver `load_icc_raster`), para leer valores
+    puntuales de la misma versión del fichero que se pinta.
+    """
+    data, folium_bounds = reproject_icc_raster(raster_path)
+    return data, folium_bounds, load_icc_raster(raster_path)
+
+
+# =========================
+# HUELLAS DE FICHEROS
+# =========================
+def ficheros_capa(path):
+    """Ficheros de los que depende una capa (un shapefile son varios)."""
+    if path is None:
+        return []
+    base, extension = os.path.splitext(path)
+    if extension.lower() == ".shp":
+        return [base + ext for ext in EXTENSIONES_SHAPEFILE if os.path.exists(base + ext)]
+    return [path]
+
+
+def huella_stat(ficheros):
+    """(mtime, tamaño) de cada fichero: barata, para detectar posibles cambios."""
+    huella = []
+    for path in ficheros:
+        try:
+            st = os.stat(path)
+        except OSError:
+            huella.append((path, None, None))
+            continue
+        huella.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(huella)
+
+
+def huella_contenido(ficheros, bloque=1024 ** 2):
+    """SHA-256 del contenido; confirma el cambio y sirve de versión de la capa."""
+    h = hashlib.sha256()
+    for path in ficheros:
+        h.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            for trozo in iter(lambda: f.read(bloque), b""):
+                h.update(trozo)
+    return h.hexdigest()
+
+
+def estimar_memoria(*capas):
+    """Bytes aproximados de GeoDataFrames (atributos + vértices) y arrays raster."""
+    total = 0
+    for capa in capas:
+        if isinstance(capa, np.ndarray):
+            total += capa.nbytes
+            continue
+        total += int(capa.drop(columns=capa.geometry.name).memory_usage(deep=True).sum())
+        total += int(shapely.get_num_coordinates(capa.geometry.values).sum()) * BYTES_POR_COORDENADA
+    return total
+
+
+# =========================
+# REGISTRO
+# =========================
+CAPAS_VECTORIALES = ("parcelas", "zonas_verdes", "arboles")
+
+
+def _todos(futuros):
+    return [futuros[capa] for capa in CAPAS_VECTORIALES] + list(futuros["icc"].values())
+
+
+def _futuro(futuros, clave):
+    if clave.startswith("icc:"):
+        return futuros["icc"][clave[4:]]
+    return futuros[clave]
+
+
+def version(futuros, clave):
+    """
+    Versión (hash de contenido) de una capa ya cargada.
+
+    `clave` es "parcelas", "zonas_verdes", "arboles" o "icc:<estación>".
+    Las cachés derivadas la incluyen en su clave para no mezclar datos de
+    distintas versiones del mismo fichero.
+    """
+    _futuro(futuros, clave).result()
+    return futuros["huellas"][clave]["hash"]
+
+
+class RegistroDistritos:
+    """
+    Distritos cargados bajo demanda con expulsión LRU por presupuesto de memoria.
+
+    Cada distrito se guarda como un diccionario de futures, uno por capa
+    (parcelas, zonas verdes, árboles y un raster ICC por estación), que se
+    leen en paralelo en un pool de hilos. Es compartido por todas las
+    sesiones del proceso: dos sesiones que piden el mismo distrito en frío
+    comparten los mismos futures y cada fichero se lee una sola vez.
+
+    Con `vigilar()` un hilo comprueba los ficheros de los distritos cargados;
+    cuando uno cambia de contenido se recarga solo esa capa en un diccionario
+    nuevo, se precalculan los derivados (`al_recargar`) y después se sustituye
+    el diccionario publicado de una vez. Las sesiones siguen usando la
+    versión anterior hasta el cambio.
+
+    Si una capa no se puede leer, el resto del distrito se conserva y esa
+    capa se reintenta en segundo plano con esperas crecientes; mientras
+    tanto su future queda con la excepción.
+    """
+
+    def __init__(
+        self,
+        config,
+        uso_path=USO_PATH,
+        max_hilos=MAX_HILOS_CARGA
+    ):
+        self.config = config
+        self.presupuesto = int(config.get("presupuesto_memoria_mb", 1024) * 1024 ** 2)
+        self._cargados = OrderedDict()
+        self._preparando = {}
+        self._bytes = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_hilos,
+            thread_name_prefix="carga-distritos"
+        )
+
+        self._al_recargar = []
+        self._stat_visto = {}
+        self._vigilante = None
+
+        self._uso_path = uso_path
+        self._lock_uso = threading.Lock()
+        self.uso = Counter(self._leer_uso())
+
+    def distritos(self):
+        return {d: cfg.get("nombre", d) for d, cfg in self.config["distritos"].items()}
+
+    def distrito(self, distrito_id):
+        return self.config["distritos"][distrito_id]
+
+    def solicitar(self, distrito_id, contar=True):
+        """
+        Lanza la carga del distrito si no está en memoria y devuelve sus futures.
+
+        No bloquea: {"parcelas": Future, "zonas_verdes": Future,
+        "arboles": Future, "icc": {estación: Future}, "huellas": {...}}.
+        """
+        with self._lock:
+            if contar:
+                self.uso[distrito_id] += 1
+            futuros = self._cargados.get(distrito_id)
+            nuevo = futuros is None
+            if nuevo:
+                futuros = self._lanzar(distrito_id)
+                self._cargados[distrito_id] = futuros
+            self._cargados.move_to_end(distrito_id)
+
+        if nuevo:
+            # Fuera del lock: un future ya terminado ejecuta el callback aquí mismo
+            for futuro in _todos(futuros):
+                futuro.add_done_callback(
+                    lambda _, f=futuros: self._al_completar(distrito_id, f)
+                )
+        if contar:
+            self._guardar_uso()
+        return futuros
+
+    def capa(self, distrito_id, clave, version_capa, futuros=None):
+        """
+        Valor de una capa en una versión concreta (espera a que esté cargada).
+
+        Busca en `futuros` (los que tiene la sesión que la pide), en la
+        versión publicada y en la que se está preparando, de modo que los
+        derivados se pueden precalcular antes de publicar el cambio. Si esa
+        versión ya no está en ninguno lanza LookupError: no se sustituye por
+        otra, porque el resultado se guarda en caché con la versión pedida.
+        """
+        with self._lock:
+            candidatos = [futuros, self._cargados.get(distrito_id), self._preparando.get(distrito_id)]
+        for candidato in candidatos:
+            if candidato is None:
+                continue
+            huella = candidato["huellas"].get(clave)
+            if huella is not None and huella["hash"] == version_capa:
+                return _futuro(candidato, clave).result()
+        raise LookupError(f"{clave} de {distrito_id} ya no está en memoria en la versión {version_capa}")
+
+    def precargar(self, n=None):
+        """Lanza en segundo plano la carga de los `n` distritos más usados."""
+        n = self.config.get("precargar", 1) if n is None else n
+        orden = sorted(
+            self.config["distritos"],
+            key=lambda d: -self.uso.get(d, 0)
+        )[:n]
+        for distrito_id in orden:
+            self.solicitar(distrito_id, contar=False)
+        return orden
+
+    # =========================
+    # RECARGA EN CALIENTE
+    # =========================
+    def al_recargar(self, funcion):
+        """
+        Registra `funcion(distrito_id, futuros, cambiadas)` para precalcular
+        derivados de las capas recargadas antes de publicarlas.
+        """
+        self._al_recargar.append(funcion)
+
+    def vigilar(self, intervalo=None):
+        """Arranca (una vez) el hilo que comprueba los ficheros cada `intervalo` segundos."""
+        intervalo = intervalo or self.config.get("vigilar_cada_s", VIGILAR_CADA)
+        if self._vigilante is not None:
+            return self._vigilante
+
+        def _bucle():
+            while True:
+                time.sleep(intervalo)
+                try:
+                    self.comprobar_cambios()
+                except Exception:
+                    logger.exception("Error comprobando cambios en los ficheros")
+
+        self._vigilante = threading.Thread(target=_bucle, name="vigilante-distritos", daemon=True)
+        self._vigilante.start()
+        return self._vigilante
+
+    def comprobar_cambios(self):
+        """
+        Recarga las capas cuyos ficheros han cambiado de contenido.
+
+        Un cambio de mtime/tamaño solo se atiende cuando se repite igual en
+        dos comprobaciones seguidas (el fichero ya no se está escribiendo) y
+        se confirma con el hash; si el contenido es el mismo solo se actualiza
+        la huella. Devuelve {distrito: [capas recargadas]}.
+        """
+        with self._lock:
+            publicados = [
+                (d, futuros) for d, futuros in self._cargados.items()
+                if d not in self._preparando
+            ]
+
+        recargas = {}
+        for distrito_id, futuros in publicados:
+            if not all(f.done() for f in _todos(futuros)):
+                continue
+
+            cambiadas = []
+            for clave, (_, _, path) in self._fuentes(distrito_id).items():
+                huella = futuros["huellas"].get(clave)
+                if huella is None:
+                    continue
+
+                ficheros = ficheros_capa(path)
+                stat = huella_stat(ficheros)
+                visto = (distrito_id, clave)
+                if stat == huella["stat"]:
+                    self._stat_visto.pop(visto, None)
+                    continue
+                if self._stat_visto.get(visto) != stat:
+                    self._stat_visto[visto] = stat
+                    continue
+                del self._stat_visto[visto]
+
+                try:
+                    contenido = huella_contenido(ficheros)
+                except OSError:
+                    continue
+                if contenido == huella["hash"]:
+                    huella["stat"] = stat
+                    continue
+                cambiadas.append(clave)
+
+            if cambiadas:
+                self._recargar(distrito_id, futuros, cambiadas)
+                recargas[distrito_id] = cambiadas
+
+        return recargas
+
+    def _recargar(self, distrito_id, futuros, cambiadas, intento=0):
+        nuevos = dict(futuros)
+        nuevos["icc"] = dict(futuros["icc"])
+        nuevos["huellas"] = {clave: dict(h) for clave, h in futuros["huellas"].items()}
+
+        fuentes = self._fuentes(distrito_id)
+        for clave in cambiadas:
+            futuro = self._lanzar_capa(nuevos, clave, fuentes[clave])
+            if clave.startswith("icc:"):
+                nuevos["icc"][clave[4:]] = futuro
+            else:
+                nuevos[clave] = futuro
+
+        with self._lock:
+            self._preparando[distrito_id] = nuevos
+
+        logger.info("Recargando %s: %s", distrito_id, ", ".join(cambiadas))
+        threading.Thread(
+            target=self._publicar,
+            args=(distrito_id, futuros, nuevos, cambiadas, intento),
+            name=f"recarga-{distrito_id}",
+            daemon=True
+        ).start()
+
+    def _publicar(self, distrito_id, anteriores, nuevos, cambiadas, intento=0):
+        wait([_futuro(nuevos, clave) for clave in cambiadas])
+        fallidas = [c for c in cambiadas if _futuro(nuevos, c).exception() is not None]
+
+        # Una recarga por cambio que falla deja la versión anterior (la
+        # siguiente comprobación lo vuelve a intentar); un reintento que
+        # recupera alguna capa se publica aunque otras sigan fallando
+        if fallidas and (not intento or len(fallidas) == len(cambiadas)):
+            with self._lock:
+                if self._preparando.get(distrito_id) is nuevos:
+                    del self._preparando[distrito_id]
+            if intento:
+                self._reintentar_mas_tarde(distrito_id, anteriores, fallidas, intento + 1)
+            else:
+                logger.error("No se pudo recargar %s; se mantiene la versión anterior", distrito_id)
+            return
+
+        # A los derivados solo se les pasan las capas que sí se han leído
+        cambiadas = [c for c in cambiadas if c not in fallidas]
+        for funcion in self._al_recargar:
+            try:
+                funcion(distrito_id, nuevos, cambiadas)
+            except Exception:
+                logger.exception("Error precalculando derivados de %s", distrito_id)
+
+        total = self._medir(nuevos)
+
+        with self._lock:
+            if self._preparando.get(distrito_id) is not nuevos:
+                return
+            del self._preparando[distrito_id]
+            # Si se expulsó mientras tanto, no se resucita
+            if self._cargados.get(distrito_id) is not anteriores:
+                return
+            self._cargados[distrito_id] = nuevos
+            self._bytes[distrito_id] = total
+            self._expulsar(conservar=distrito_id)
+
+        if fallidas:
+            self._reintentar_mas_tarde(distrito_id, nuevos, fallidas, intento + 1)
+
+    # =========================
+    # CARGA DE CAPAS
+    # =========================
+    def _fuentes(self, distrito_id):
+        """{clave de capa: (lector, argumento, fichero principal)}."""
+        distrito = self.distrito(distrito_id)
+        fuentes = {
+            "parcelas": (load_data, distrito, distrito["parcelas"]["path"]),
+            "zonas_verdes": (_capa_vegetacion, distrito["zonas_verdes"], distrito["zonas_verdes"]),
+            "arboles": (_capa_vegetacion, distrito["arboles"], distrito["arboles"]),
+        }
+        for estacion, path in distrito["icc_rasters"].items():
+            fuentes[f"icc:{estacion}"] = (leer_icc_raster, path, path)
+        return fuentes
+
+    def _lanzar_capa(self, futuros, clave, fuente):
+        lector, argumento, path = fuente
+        return self._pool.submit(self._leer_capa, futuros, clave, lector, argumento, path)
+
+    @staticmethod
+    def _leer_capa(futuros, clave, lector, argumento, path):
+        # La huella se toma antes de leer: si el fichero cambia durante la
+        # lectura, la siguiente comprobación lo detecta y vuelve a cargarlo
+        ficheros = ficheros_capa(path)
+        huella = {"stat": huella_stat(ficheros), "hash": huella_contenido(ficheros)}
+        valor = lector(argumento)
+        futuros["huellas"][clave] = huella
+        return valor
+
+    def _lanzar(self, distrito_id):
+        # Se llama con self._lock adquirido
+        futuros = {"icc": {}, "huellas": {}}
+        for clave, fuente in self._fuentes(distrito_id).items():
+            futuro = self._lanzar_capa(futuros, clave, fuente)
+            if clave.startswith("icc:"):
+                futuros["icc"][clave[4:]] = futuro
+            else:
+                futuros[clave] = futuro
+        return futuros
+
+    def _medir(self, futuros):
+        # Las capas que fallaron no ocupan memoria
+        capas = [
+            futuros[capa].result() for capa in CAPAS_VECTORIALES
+            if futuros[capa].exception() is None
+        ]
+        for futuro in futuros["icc"].values():
+            if futuro.exception() is None:
+                data, _, original = futuro.result()
+                capas += [data, original[0]]
+        return estimar_memoria(*capas)
+
+    def _al_completar(self, distrito_id, futuros):
+        if not all(f.done() for f in _todos(futuros)):
+            return
+
+        with self._lock:
+            # El distrito pudo expulsarse o recargarse mientras tanto
+            if self._cargados.get(distrito_id) is not futuros or distrito_id in self._bytes:
+                return
+
+        total = self._medir(futuros)
+
+        with self._lock:
+            if self._cargados.get(distrito_id) is not futuros:
+                return
+            self._bytes[distrito_id] = total
+            self._expulsar(conservar=distrito_id)
+
+        # Las capas leídas se conservan; solo se reintentan las que fallaron
+        fallidas = [
+            clave for clave in self._fuentes(distrito_id)
+            if _futuro(futuros, clave).exception() is not None
+        ]
+        if fallidas:
+            self._reintentar_mas_tarde(distrito_id, futuros, fallidas, 1)
+
+    def _reintentar_mas_tarde(self, distrito_id, futuros, fallidas, intento):
+        espera = min(ESPERA_REINTENTO * 2 ** (intento - 1), ESPERA_REINTENTO_MAX)
+        for clave in fallidas:
+            logger.warning(
+                "No se pudo cargar %s de %s (%s); reintento %d en %.0f s",
+                clave, distrito_id, _futuro(futuros, clave).exception(), intento, espera
+            )
+        temporizador = threading.Timer(
+            espera,
+            self._reintentar,
+            args=(distrito_id, futuros, fallidas, intento)
+        )
+        temporizador.daemon = True
+        temporizador.start()
+
+    def _reintentar(self, distrito_id, futuros, fallidas, intento):
+        with self._lock:
+            # Expulsado o sustituido por otra versión: ya no hay nada que reintentar
+            if self._cargados.get(distrito_id) is not futuros:
+                return
+            ocupado = distrito_id in self._preparando
+        if ocupado:
+            self._reintentar_mas_tarde(distrito_id, futuros, fallidas, intento)
+            return
+        self._recargar(distrito_id, futuros, fallidas, intento)
+
+    def _expulsar(self, conservar):
+        # Se llama con self._lock adquirido; los distritos aún en carga no se expulsan
+        total = sum(self._bytes.values())
+        for distrito_id in list(self._cargados):
+            if total <= self.presupuesto:
+                break
+            if distrito_id == conservar or distrito_id not in self._bytes:
+                continue
+            del self._cargados[distrito_id]
+            total -= self._bytes.pop(distrito_id)
+
+    def _leer_uso(self):
+        try:
+            with open(self._uso_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _guardar_uso(self):
+        # Se guarda en cada visita contada (una por sesión), así no se pierde
+        # nada al parar el proceso. Se escribe en un temporal y se renombra
+        # para que una parada a medias no deje el fichero truncado.
+        with self._lock_uso:
+            with self._lock:
+                uso = dict(self.uso)
+            temporal = f"{self._uso_path}.tmp"
+            try:
+                with open(temporal, "w", encoding="utf-8") as f:
+                    json.dump(uso, f)
+                os.replace(temporal, self._uso_path)
+            except OSError:
+                pass
+
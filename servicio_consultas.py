@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+Servicio de consultas – valores de parcelas y rasters ICC por HTTP/JSON
+
+Uso:
+    python servicio_consultas.py --puerto 8765
+
+Rutas:
+    GET  /distritos
+    GET  /parcela?distrito=rochapea&id=12[&columnas=a,b]
+    POST /parcelas       {"distrito": ..., "ids": [...], "columnas": [...]}
+    GET  /punto?distrito=rochapea&lon=-1.65&lat=42.83
+    POST /puntos         {"distrito": ..., "lon": [...], "lat": [...]}
+    GET  /estadisticas?distrito=rochapea&columna=Poblacion_
+"""
+
+import argparse
+import json
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from registro_distritos import (
+    MAP_CRS,
+    RegistroDistritos,
+    cargar_config,
+    sample_icc_raster,
+    version,
+)
+
+
+MAX_RESPUESTAS_CACHE = 4096
+MAX_LOTE = 10000
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorConsulta(Exception):
+    """Error de la petición, con el código HTTP que se devuelve al cliente."""
+
+    def __init__(self, mensaje, estado=400):
+        super().__init__(mensaje)
+        self.estado = estado
+
+
+# =========================
+# CACHÉ DE RESPUESTAS
+# =========================
+class CacheRespuestas:
+    """
+    LRU en memoria de respuestas ya serializadas, compartida entre hilos.
+
+    La clave incluye la versión de las capas de las que depende la
+    respuesta, así que tras una recarga las entradas antiguas dejan de
+    pedirse y salen por LRU.
+    """
+
+    def __init__(self, max_entradas=MAX_RESPUESTAS_CACHE):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave):
+        with self._lock:
+            cuerpo = self._entradas.get(clave)
+            if cuerpo is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return cuerpo
+
+    def guardar(self, clave, cuerpo):
+        with self._lock:
+            self._entradas[clave] = cuerpo
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+
+def _por_defecto(valor):
+    if isinstance(valor, np.generic):
+        return valor.item()
+    if isinstance(valor, np.ndarray):
+        return valor.tolist()
+    raise TypeError(f"No serializable: {type(valor).__name__}")
+
+
+def _sin_nan(valores):
+    return [None if not np.isfinite(v) else float(v) for v in valores]
+
+
+def serializar(datos):
+    return json.dumps(datos, default=_por_defecto, ensure_ascii=False).encode("utf-8")
+
+
+# =========================
+# CONSULTAS
+# =========================
+class Consultas:
+    """
+    Consultas sobre los distritos del registro; sin estado de petición.
+
+    Las peticiones no cuentan como uso del distrito: el orden de precarga
+    lo deciden las sesiones del visor.
+    """
+
+    def __init__(self, registro):
+        self.registro = registro
+        self._atributos = {}
+        self._lock = threading.Lock()
+
+    def _distrito(self, distrito_id):
+        if distrito_id not in self.registro.config["distritos"]:
+            raise ErrorConsulta(f"Distrito desconocido: {distrito_id}", 404)
+        return self.registro.distrito(distrito_id)
+
+    def versiones(self, distrito_id, capas):
+        """
+        Versiones (hash de contenido) de las capas de una respuesta.
+
+        `capas` contiene "parcelas" y/o "icc" (todos los rasters del distrito);
+        un raster que no se pudo cargar cuenta como versión None.
+        """
+        self._distrito(distrito_id)
+        futuros = self.registro.solicitar(distrito_id, contar=False)
+        versiones = [version(futuros, "parcelas")] if "parcelas" in capas else []
+        if "icc" in capas:
+            for estacion, futuro in sorted(futuros["icc"].items()):
+                fallido = futuro.exception() is not None
+                versiones.append(None if fallido else version(futuros, f"icc:{estacion}"))
+        return tuple(versiones)
+
+    def _parcelas(self, distrito_id):
+        self._distrito(distrito_id)
+        return self.registro.solicitar(distrito_id, contar=False)["parcelas"].result()
+
+    def atributos(self, distrito_id):
+        """
+        Atributos de las parcelas sin geometría, indexados por id de parcela.
+
+        El id es el fid del fichero de parcelas o, si el distrito declara
+        `columna_id`, el valor de esa columna.
+        """
+        gdf = self._parcelas(distrito_id)
+        with self._lock:
+            # Se rehace solo si el registro ha recargado la capa
+            cacheado = self._atributos.get(distrito_id)
+            if cacheado is not None and cacheado[0]() is gdf:
+                return cacheado[1]
+
+        atributos = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+        columna_id = self._distrito(distrito_id).get("columna_id")
+        if columna_id:
+            atributos = atributos.set_index(columna_id, drop=False)
+
+        # Solo una referencia débil a gdf: cuando el registro lo expulsa o lo
+        # sustituye por otra versión, sus atributos se descartan con él
+        referencia = weakref.ref(gdf)
+        with self._lock:
+            self._atributos[distrito_id] = (referencia, atributos)
+        weakref.finalize(gdf, self._olvidar, distrito_id, referencia)
+        return atributos
+
+    def _olvidar(self, distrito_id, referencia):
+        with self._lock:
+            cacheado = self._atributos.get(distrito_id)
+            if cacheado is not None and cacheado[0] is referencia:
+                del self._atributos[distrito_id]
+
+    def _ids(self, atributos, ids):
+        if pd.api.types.is_integer_dtype(atributos.index):
+            try:
+                return [int(i) for i in ids]
+            except (TypeError, ValueError):
+                raise ErrorConsulta("Los ids de parcela deben ser enteros")
+        return [str(i) for i in ids]
+
+    def _columnas(self, atributos, columnas):
+        if not columnas:
+            return list(atributos.columns)
+        desconocidas = [c for c in columnas if c not in atributos.columns]
+        if desconocidas:
+            raise ErrorConsulta(f"Columnas desconocidas: {desconocidas}", 404)
+        return list(columnas)
+
+    def distritos(self):
+        return {"distritos": self.registro.distritos()}
+
+    def parcelas(self, distrito_id, ids, columnas=None):
+        if len(ids) > MAX_LOTE:
+            raise ErrorConsulta(f"Máximo {MAX_LOTE} parcelas por petición")
+        atributos = self.atributos(distrito_id)
+        columnas = self._columnas(atributos, columnas)
+        ids = self._ids(atributos, ids)
+
+        filas = atributos.reindex(ids)[columnas]
+        filas = filas.astype(object).where(filas.notna(), None)
+
+        return {
+            "distrito": distrito_id,
+            "parcelas": [
+                {"id": i, "valores": valores}
+                for i, valores in zip(ids, filas.to_dict(orient="records"))
+            ],
+            "no_encontradas": pd.Index(ids).difference(atributos.index).tolist(),
+        }
+
+    def parcela(self, distrito_id, id_parcela, columnas=None):
+        respuesta = self.parcelas(distrito_id, [id_parcela], columnas)
+        if respuesta["no_encontradas"]:
+            raise ErrorConsulta(f"Parcela no encontrada: {id_parcela}", 404)
+        return {"distrito": distrito_id, **respuesta["parcelas"][0]}
+
+    def puntos(self, distrito_id, lons, lats):
+        if len(lons) != len(lats):
+            raise ErrorConsulta("lon y lat deben tener la misma longitud")
+        if len(lons) > MAX_LOTE:
+            raise ErrorConsulta(f"Máximo {MAX_LOTE} puntos por petición")
+        try:
+            lons = np.asarray(lons, dtype=float)
+            lats = np.asarray(lats, dtype=float)
+        except (TypeError, ValueError):
+            raise ErrorConsulta("lon y lat deben ser numéricos")
+
+        self._distrito(distrito_id)
+        futuros = self.registro.solicitar(distrito_id, contar=False)
+
+        # ICC a nivel de calle en todas las estaciones, leído de la banda
+        # original que guarda el registro; un raster que no se pudo cargar
+        # devuelve null y se indica en "errores"
+        icc, errores = {}, {}
+        for estacion, futuro in futuros["icc"].items():
+            if futuro.exception() is not None:
+                icc[estacion] = [None] * len(lons)
+                errores[estacion] = "No se pudo cargar el raster ICC"
+                continue
+            original = futuro.result()[2]
+            icc[estacion] = _sin_nan(sample_icc_raster(original, lons, lats))
+
+        # Parcela que contiene cada punto
+        gdf = self._parcelas(distrito_id)
+        puntos = gpd.points_from_xy(lons, lats, crs=f"EPSG:{MAP_CRS}")
+        i_punto, i_parcela = gdf.sindex.query(puntos, predicate="within")
+        parcelas = [None] * len(lons)
+        ids = self.atributos(distrito_id).index
+        for i, j in zip(i_punto, i_parcela):
+            if parcelas[i] is None:
+                parcelas[i] = ids[j]
+
+        return {
+            "distrito": distrito_id,
+            "lon": lons.tolist(),
+            "lat": lats.tolist(),
+            "icc_calle": icc,
+            "parcela": parcelas,
+            "errores": errores,
+        }
+
+    def punto(self, distrito_id, lon, lat):
+        respuesta = self.puntos(distrito_id, [lon], [lat])
+        return {
+            "distrito": distrito_id,
+            "lon": respuesta["lon"][0],
+            "lat": respuesta["lat"][0],
+            "icc_calle": {e: v[0] for e, v in respuesta["icc_calle"].items()},
+            "parcela": respuesta["parcela"][0],
+            "errores": respuesta["errores"],
+        }
+
+    def estadisticas(self, distrito_id, columna):
+        atributos = self.atributos(distrito_id)
+        self._columnas(atributos, [columna])
+        serie = atributos[columna]
+
+        # Algunas columnas numéricas vienen como texto (p. ej. Poblacion_):
+        # solo se tratan como categóricas si no contienen ningún número
+        numerica = pd.to_numeric(serie, errors="coerce")
+        if numerica.notna().sum() == 0 and serie.notna().any():
+            conteo = serie.fillna("Sin dato").astype(str).value_counts()
+            return {
+                "distrito": distrito_id,
+                "columna": columna,
+                "tipo": "categorica",
+                "n": int(serie.notna().sum()),
+                "frecuencias": conteo.to_dict(),
+            }
+
+        valores = numerica.to_numpy(dtype=float)
+        validos = valores[np.isfinite(valores)]
+        estadisticas = {
+            "distrito": distrito_id,
+            "columna": columna,
+            "tipo": "numerica",
+            "n": int(validos.size),
+            "sin_dato": int(valores.size - validos.size),
+        }
+        if validos.size:
+            estadisticas.update({
+                "media": float(validos.mean()),
+                "desviacion": float(validos.std(ddof=1)) if validos.size > 1 else 0.0,
+                "min": float(validos.min()),
+                "max": float(validos.max()),
+                "suma": float(validos.sum()),
+                "percentiles": dict(zip(
+                    [str(p) for p in PERCENTILES],
+                    np.percentile(validos, PERCENTILES).tolist()
+                )),
+            })
+        return estadisticas
+
+
+# =========================
+# SERVIDOR HTTP
+# =========================
+def _parametro(query, nombre, obligatorio=True):
+    valores = query.get(nombre)
+    if not valores:
+        if obligatorio:
+            raise ErrorConsulta(f"Falta el parámetro '{nombre}'")
+        return None
+    return valores[0]
+
+
+def _float(valor, nombre):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        raise ErrorConsulta(f"'{nombre}' debe ser numérico")
+
+
+def _lista(valor):
+    return [v for v in valor.split(",") if v] if valor else None
+
+
+def _campo(cuerpo, nombre, obligatorio=True, tipo=None):
+    if not isinstance(cuerpo, dict):
+        raise ErrorConsulta("El cuerpo debe ser un objeto JSON")
+    if cuerpo.get(nombre) is None:
+        if obligatorio:
+            raise ErrorConsulta(f"Falta el campo '{nombre}'")
+        return None
+    if tipo is not None and not isinstance(cuerpo[nombre], tipo):
+        raise ErrorConsulta(f"'{nombre}' no es válido")
+    return cuerpo[nombre]
+
+
+def _campo_lista(cuerpo, nombre, obligatorio=True, tipo=None):
+    valor = _campo(cuerpo, nombre, obligatorio)
+    if valor is not None and not isinstance(valor, list):
+        raise ErrorConsulta(f"'{nombre}' debe ser una lista")
+    if valor and tipo is not None and not all(isinstance(v, tipo) for v in valor):
+        raise ErrorConsulta(f"'{nombre}' tiene elementos no válidos")
+    return valor
+
+
+def crear_manejador(consultas, cache):
+
+    # Ruta → (argumentos de la petición, consulta, capas de las que depende la respuesta)
+    rutas_get = {
+        "/distritos": (lambda q: (), consultas.distritos, ()),
+        "/parcela": (lambda q: (
+            _parametro(q, "distrito"),
+            _parametro(q, "id"),
+            _lista(_parametro(q, "columnas", obligatorio=False))
+        ), consultas.parcela, ("parcelas",)),
+        "/punto": (lambda q: (
+            _parametro(q, "distrito"),
+            _float(_parametro(q, "lon"), "lon"),
+            _float(_parametro(q, "lat"), "lat")
+        ), consultas.punto, ("parcelas", "icc")),
+        "/estadisticas": (lambda q: (
+            _parametro(q, "distrito"),
+            _parametro(q, "columna")
+        ), consultas.estadisticas, ("parcelas",)),
+    }
+
+    rutas_post = {
+        "/parcelas": (lambda c: (
+            _campo(c, "distrito", tipo=str),
+            _campo_lista(c, "ids"),
+            _campo_lista(c, "columnas", obligatorio=False, tipo=str)
+        ), consultas.parcelas, ("parcelas",)),
+        "/puntos": (lambda c: (
+            _campo(c, "distrito", tipo=str),
+            _campo_lista(c, "lon"),
+            _campo_lista(c, "lat")
+        ), consultas.puntos, ("parcelas", "icc")),
+    }
+
+    class Manejador(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            clave = ("GET", url.path, tuple(sorted((k, tuple(v)) for k, v in query.items())))
+            self._responder(rutas_get.get(url.path), query, clave)
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            longitud = int(self.headers.get("Content-Length") or 0)
+            crudo = self.rfile.read(longitud)
+            try:
+                cuerpo = json.loads(crudo or b"{}")
+            except ValueError:
+                self._enviar(400, serializar({"error": "JSON no válido"}))
+                return
+            clave = ("POST", url.path, json.dumps(cuerpo, sort_keys=True))
+            self._responder(rutas_post.get(url.path), cuerpo, clave)
+
+        def _responder(self, ruta, peticion, clave):
+            if ruta is None:
+                self._enviar(404, serializar({"error": "Ruta desconocida"}))
+                return
+
+            leer_argumentos, consulta, capas = ruta
+            try:
+                # Solo los fallos al leer la petición son culpa del cliente (400)
+                try:
+                    argumentos = leer_argumentos(peticion)
+                except (KeyError, TypeError, ValueError) as e:
+                    raise ErrorConsulta(f"Petición no válida: {e}")
+                if capas:
+                    # El distrito es siempre el primer argumento
+                    clave += consultas.versiones(argumentos[0], capas)
+                cuerpo = cache.obtener(clave)
+                if cuerpo is None:
+                    cuerpo = serializar(consulta(*argumentos))
+                    cache.guardar(clave, cuerpo)
+            except ErrorConsulta as e:
+                self._enviar(e.estado, serializar({"error": str(e)}))
+                return
+            except Exception:
+                # Sin esto se cierra la conexión sin responder al cliente
+                logger.exception("Error atendiendo %s %s", self.command, self.path)
+                self._enviar(500, serializar({"error": "Error interno del servicio"}))
+                return
+
+            self._enviar(200, cuerpo)
+
+        def _enviar(self, estado, cuerpo):
+            self.send_response(estado)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, formato, *args):
+            pass
+
+    return Manejador
+
+
+def crear_servidor(host="127.0.0.1", puerto=8765, config_path=None, max_cache=MAX_RESPUESTAS_CACHE):
+    config = cargar_config(config_path) if config_path else cargar_config()
+    registro = RegistroDistritos(config)
+    registro.precargar()
+
+    consultas = Consultas(registro)
+    cache = CacheRespuestas(max_cache)
+
+    registro.vigilar()
+
+    servidor = ThreadingHTTPServer((host, puerto), crear_manejador(consultas, cache))
+    servidor.daemon_threads = True
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio de consultas del visor")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--config", default=None, help="Fichero de distritos (por defecto distritos.json)")
+    parser.add_argument("--cache", type=int, default=MAX_RESPUESTAS_CACHE, help="Respuestas en caché")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    servidor = crear_servidor(args.host, args.puerto, args.config, args.cache)
+    print(f"Servicio de consultas en http://{args.host}:{args.puerto}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+
+if __name__ == "__main__":
+    main()
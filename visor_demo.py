@@ -4,7 +4,7 @@ Visor Rochapea – Escenarios, Demografía y Catastro
 """
 
 import streamlit as st
-import geopandas as gpd
+import streamlit.components.v1 as components
 import folium
 from streamlit_folium import st_folium
 import branca.colormap as cm
@@ -13,27 +13,35 @@ from rasterio.plot import reshape_as_image
 import matplotlib.pyplot as plt
 import io
 import base64
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
 from pyproj import Transformer
 
+from proximidad import (
+    CRS_METRICO,
+    RADIOS_PROXIMIDAD,
+    columna_area,
+    columna_arboles,
+    columna_distancia,
+    indice_proximidad,
+)
+from registro_distritos import RegistroDistritos, cargar_config, version
+
 
 # =========================
 # CONFIG
 # =========================
-GPKG_PATH = "parcelas_rochapea_completas.gpkg"
-LAYER_NAME = "parcelas_rochapea"
-
-ZONAS_VERDES_PATH = "simulacion_zonas_verdes_rochapea_RECUPERADA.shp"
-ARBOLES_PATH = "arboles_propuestos.shp"
-ICC_RASTERS = {
-    "Invierno": "ICC_invierno.tif",
-    "Primavera": "ICC_primavera.tif",
-    "Verano": "ICC_verano.tif",
-    "Otoño": "ICC_otono.tif",
-    "Media anual": "ICC_anual.tif"
-}
+# Las rutas de cada distrito (parcelas, vegetación, rasters ICC) están en
+# distritos.json y se gestionan con RegistroDistritos.
 
+# Entradas máximas por caché derivada (un juego por distrito cargado)
+MAX_DISTRITOS_CACHE = 4
 
-MAP_CRS = 4326
+# Espera máxima (s) antes de relanzar el script mientras hay capas cargándose
+INTERVALO_SONDEO = 1.0
 
 # Rangos fijos
 RANGO_REDICCION_CONTAMINACION = (0.0, 20.0)
@@ -96,6 +104,28 @@ Valores más altos indican una mayor reducción de la carga contaminante atmosf
 (NO₂, PM₂.₅ y PM₁₀) asociada a la estrategia de vegetación considerada.
 """
 
+TEXTO_EXPOSICION_VEGETACION = """
+**Exposición a la vegetación propuesta**
+
+Relaciona cada parcela con las nuevas zonas verdes y el arbolado propuestos en el escenario:
+distancia a la zona verde más cercana, número de árboles y superficie verde dentro de un radio
+alrededor de la parcela. En el escenario prioritario solo se considera la vegetación de prioridad 1.
+
+Las distancias y superficies se calculan en metros sobre un sistema de coordenadas proyectado.
+"""
+
+TEXTO_ICC_ESTIMADO = """
+**ICC estimado en los escenarios ideal y prioritario**
+
+El ICC por parcela solo está disponible para la vegetación actual. En los escenarios ideal y
+prioritario se estima aplicando al ICC actual de cada estación la reducción anual del escenario:
+
+ICC estimado(e, v) = ICC actual(e, v) · (1 − R(v) / 100)
+
+donde *R(v)* es el porcentaje de reducción anual del ICC en la parcela *v* para ese escenario.
+Al ser una reducción anual, se aplica por igual a todas las estaciones.
+"""
+
 
 
 # =========================
@@ -127,144 +157,759 @@ ICC_ACTUAL_COLS = {
     "Media anual": "ICC Media Anual (0-100)"
 }
 
+# =========================
+# MAPEO ICC – REDUCCIÓN POR ESCENARIO
+# =========================
+REDUCCION_ICC_COLS = {
+    "Ideal": "ESCENARIO 1: Porcentaje de reducción del índice de contaminación (ICC) en escenario Ideal (0-100)",
+    "Prioritario": "ESCENARIO 2: Porcentaje de reducción del índice de contaminación (ICC) en escenario Prioritario (0-100)",
+}
+
+# =========================
+# RESUMEN DEL BARRIO – DIMENSIONES DE LOS CUBOS
+# =========================
+ESCENARIOS = ["Actual", "Ideal", "Prioritario"]
+ESTACIONES = ["Invierno", "Primavera", "Verano", "Otoño"]
+
+POBLACION_COL = "Poblacion_"
+USO_COL = "USO"
+
+# Bandas de ICC (0–60 en pasos de 10, más una banda abierta por encima)
+BANDAS_ICC = [0, 10, 20, 30, 40, 50, 60, np.inf]
+ETIQUETAS_BANDAS_ICC = ["0–10", "10–20", "20–30", "30–40", "40–50", "50–60", "≥ 60"]
+SIN_DATO = "Sin dato"
+
+
+def vulnerabilidad_col(escenario, estacion):
+    return f"Índice de Vulnerabilidad en {estacion} en el escenario {escenario} (0-100)"
+
 
 st.set_page_config(layout="wide")
-st.title("Visor urbano – Rochapea")
 
 # =========================
 # CARGA DE DATOS
 # =========================
-@st.cache_data
-def load_data():
-    return gpd.read_file(GPKG_PATH, layer=LAYER_NAME).to_crs(epsg=MAP_CRS)
-
-@st.cache_data
-def load_vegetation():
-    zonas = gpd.read_file(ZONAS_VERDES_PATH).to_crs(epsg=MAP_CRS)
-    arboles = gpd.read_file(ARBOLES_PATH).to_crs(epsg=MAP_CRS)
-    return zonas, arboles
-    
-@st.cache_data
-def load_icc_raster(raster_path):
-    import rasterio
-    with rasterio.open(raster_path) as src:
-        data = src.read(1)
-        transform = src.transform
-        crs = src.crs
-        height = src.height
-        width = src.width
-    return data, transform, crs, height, width
-
-gdf = load_data()
-zonas_verdes, arboles = load_vegetation()
+@st.cache_resource
+def get_registry():
+    """Registro compartido por todas las sesiones; precarga los distritos más usados."""
+    registro = RegistroDistritos(cargar_config())
+    registro.precargar()
+    return registro
+
+
+def load_data(distrito_id, version_parcelas, _futuros=None):
+    # _futuros (no forma parte de la clave de caché) son los de la sesión:
+    # conservan la versión pedida aunque el registro ya haya publicado otra
+    return get_registry().capa(distrito_id, "parcelas", version_parcelas, _futuros)
+
+
+# =========================
+# CAPAS EN SEGUNDO PLANO
+# =========================
+# Futures de capas que esta ejecución ha dejado fuera por no estar listas;
+# al final del script se espera a la primera y se relanza para mostrarla.
+CAPAS_PENDIENTES = []
+# Capas que fallaron: el registro las reintenta y publica futures nuevos,
+# que solo se recogen volviendo a ejecutar el script.
+CAPAS_FALLIDAS = []
+
+
+def sondear_y_relanzar():
+    """Espera a la primera capa pendiente (o INTERVALO_SONDEO) y relanza el script."""
+    if CAPAS_PENDIENTES:
+        wait(CAPAS_PENDIENTES, timeout=INTERVALO_SONDEO, return_when=FIRST_COMPLETED)
+    else:
+        time.sleep(INTERVALO_SONDEO)
+    st.rerun()
+
+
+def capa_fallida(futuro):
+    return futuro.done() and futuro.exception() is not None
+
+
+def esperar_capa(futuro, nombre):
+    """Capa imprescindible: espera con spinner; si no se pudo leer, avisa y para."""
+    if not futuro.done():
+        with st.spinner(f"Cargando {nombre}…"):
+            wait([futuro])
+    if capa_fallida(futuro):
+        st.warning(f"No se han podido cargar {nombre}. Se reintentará en unos segundos.")
+        sondear_y_relanzar()
+    return futuro.result()
+
+
+def capa_si_lista(futuro, nombre):
+    """Capa opcional: la devuelve si ya está cargada; si no, deja un aviso y la apunta."""
+    if capa_fallida(futuro):
+        st.warning(f"No se ha podido cargar: {nombre}. Se reintentará en unos segundos.")
+        CAPAS_FALLIDAS.append(futuro)
+        return None
+    if futuro.done():
+        return futuro.result()
+    CAPAS_PENDIENTES.append(futuro)
+    st.caption(f"⏳ Cargando {nombre}…")
+    return None
+
+registro = get_registry()
+distritos = registro.distritos()
+
+distrito_id = st.sidebar.selectbox(
+    "Distrito",
+    list(distritos),
+    format_func=distritos.get
+)
+
+st.title(f"Visor urbano – {distritos[distrito_id]}")
+
+# El uso (para ordenar la precarga) se cuenta una vez por sesión y distrito
+contados = st.session_state.setdefault("distritos_contados", set())
+contar_uso = distrito_id not in contados
+contados.add(distrito_id)
+
+# Parcelas, vegetación y rasters se leen en paralelo; cada modo espera solo
+# a las capas que necesita, después de pintar su barra lateral.
+futuros = registro.solicitar(distrito_id, contar=contar_uso)
+
+
+def icc_valid_mask(data):
+    # Definir rango válido real
+    return (data > 0) & np.isfinite(data)
 
-import rasterio
-import numpy as np
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import folium
+
+def icc_rgba(data, vmin, vmax, colormap="reds"):
+    valid_mask = icc_valid_mask(data)
+
+    norm = np.zeros_like(data, dtype=np.float32)
+    norm[valid_mask] = np.clip(
+        (data[valid_mask] - vmin) / max(vmax - vmin, 1e-9), 0.0, 1.0
+    )
+
+    # =========================
+    # RGBA
+    # =========================
+    rgba = np.zeros((data.shape[0], data.shape[1], 4), dtype=np.float32)
+
+    if colormap == "reds":
+        rgba[..., 0] = norm
+    elif colormap == "greens":
+        rgba[..., 1] = norm
+    elif colormap == "blues":
+        rgba[..., 2] = norm
+
+    # ALPHA SOLO DONDE HAY DATOS
+    rgba[..., 3] = np.where(valid_mask, norm * 0.9, 0.0)
+
+    return rgba
 
 
 def add_icc_raster_to_map(
     m,
-    raster_path,
+    raster,
     layer_name="ICC (nivel de calle)",
     colormap="reds"
 ):
-    import rasterio
-    import numpy as np
-    from rasterio.warp import calculate_default_transform, reproject, Resampling
-    import folium
-    import streamlit as st
-
-    with rasterio.open(raster_path) as src:
-
-        dst_crs = "EPSG:4326"
-
-        transform, width, height = calculate_default_transform(
-            src.crs,
-            dst_crs,
-            src.width,
-            src.height,
-            *src.bounds
-        )
+    # raster = (datos reproyectados, límites folium, original), ver leer_icc_raster
+    data, folium_bounds, _ = raster
 
-        data = np.empty((height, width), dtype=np.float32)
+    # =========================
+    # MÁSCARA CORRECTA
+    # =========================
+    valid_mask = icc_valid_mask(data)
 
-        reproject(
-            source=rasterio.band(src, 1),
-            destination=data,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=transform,
-            dst_crs=dst_crs,
-            resampling=Resampling.bilinear
-        )
+    if not valid_mask.any():
+        st.warning("Raster sin valores válidos")
+        return
 
-        # =========================
-        # MÁSCARA CORRECTA
-        # =========================
-        data = np.array(data)
+    rgba = icc_rgba(
+        data,
+        data[valid_mask].min(),
+        data[valid_mask].max(),
+        colormap
+    )
 
-        # Definir rango válido real
-        valid_mask = (data > 0) & np.isfinite(data)
+    fg = folium.FeatureGroup(
+        name=layer_name,
+        overlay=True,
+        control=True,
+        show=True
+    )
 
-        if not valid_mask.any():
-            st.warning("Raster sin valores válidos")
-            return
-
-        vmin = data[valid_mask].min()
-        vmax = data[valid_mask].max()
-
-        norm = np.zeros_like(data, dtype=np.float32)
-        norm[valid_mask] = (data[valid_mask] - vmin) / (vmax - vmin)
-
-        # =========================
-        # RGBA
-        # =========================
-        rgba = np.zeros((data.shape[0], data.shape[1], 4), dtype=np.float32)
-
-        if colormap == "reds":
-            rgba[..., 0] = norm
-        elif colormap == "greens":
-            rgba[..., 1] = norm
-        elif colormap == "blues":
-            rgba[..., 2] = norm
-
-        # ALPHA SOLO DONDE HAY DATOS
-        rgba[..., 3] = np.where(valid_mask, norm * 0.9, 0.0)
-
-        # =========================
-        # Bounds
-        # =========================
-        bounds = rasterio.transform.array_bounds(
-            height, width, transform
-        )
+    folium.raster_layers.ImageOverlay(
+        image=rgba,
+        bounds=folium_bounds,
+        opacity=1.0,
+        interactive=True
+    ).add_to(fg)
 
-        folium_bounds = [
-            [bounds[1], bounds[0]],  # south, west
-            [bounds[3], bounds[2]]   # north, east
-        ]
+    fg.add_to(m)
 
-        fg = folium.FeatureGroup(
-            name=layer_name,
-            overlay=True,
-            control=True,
-            show=True
-        )
+    m.fit_bounds(folium_bounds)
 
-        folium.raster_layers.ImageOverlay(
-            image=rgba,
-            bounds=folium_bounds,
-            opacity=1.0,
-            interactive=True
-        ).add_to(fg)
 
-        fg.add_to(m)
+# =========================
+# RESUMEN DEL BARRIO – CUBOS PRECALCULADOS
+# =========================
+def _numerica(gdf, columna):
+    return pd.to_numeric(gdf[columna], errors="coerce")
+
+
+def etiqueta_icc(escenario):
+    """Nombre del escenario en vistas de ICC: fuera del Actual el ICC es estimado (ver `icc_escenario`)."""
+    return escenario if escenario == "Actual" else f"{escenario} (ICC estimado)"
+
+
+def icc_escenario(gdf, escenario, estacion):
+    """ICC por parcela; en Ideal/Prioritario se estima aplicando la reducción del escenario al ICC actual."""
+    icc = _numerica(gdf, ICC_ACTUAL_COLS[estacion])
+    if escenario == "Actual":
+        return icc
+    return icc * (1 - _numerica(gdf, REDUCCION_ICC_COLS[escenario]).fillna(0.0) / 100)
+
 
-        m.fit_bounds(folium_bounds)
+@st.cache_data(max_entries=MAX_DISTRITOS_CACHE)
+def build_summary_cube(distrito_id, version_parcelas, _futuros=None):
+    """
+    Cubo escenario × estación × USO × banda ICC con sumas y recuentos.
 
+    Se calcula una sola vez a partir de las parcelas; el panel de resumen solo
+    filtra y re-agrega este DataFrame pequeño, sin volver a recorrer `gdf`.
+    El ICC de los escenarios Ideal y Prioritario se estima con `icc_escenario`.
+    """
+    gdf = load_data(distrito_id, version_parcelas, _futuros)
 
+    if USO_COL in gdf.columns:
+        uso = gdf[USO_COL].fillna(SIN_DATO).astype(str)
+    else:
+        uso = pd.Series(SIN_DATO, index=gdf.index)
+
+    if POBLACION_COL in gdf.columns:
+        poblacion = _numerica(gdf, POBLACION_COL).fillna(0.0)
+    else:
+        poblacion = pd.Series(0.0, index=gdf.index)
+
+    desde = dict(zip(ETIQUETAS_BANDAS_ICC, BANDAS_ICC[:-1]))
+    piezas = []
+
+    for escenario in ESCENARIOS:
+        for estacion in ESTACIONES:
+            icc = icc_escenario(gdf, escenario, estacion)
+            if escenario == "Actual":
+                reduccion = pd.Series(0.0, index=gdf.index)
+            else:
+                reduccion = _numerica(gdf, REDUCCION_VULNERABILIDAD_COLS[escenario][estacion])
+
+            banda = pd.cut(
+                icc,
+                bins=BANDAS_ICC,
+                right=False,
+                labels=ETIQUETAS_BANDAS_ICC
+            ).cat.add_categories(SIN_DATO).fillna(SIN_DATO)
+
+            tabla = pd.DataFrame({
+                "USO": uso,
+                "Banda ICC": banda,
+                "Población": poblacion,
+                "Vulnerabilidad": _numerica(gdf, vulnerabilidad_col(escenario, estacion)),
+                "Reducción vulnerabilidad": reduccion,
+            })
+
+            agregado = tabla.groupby(["USO", "Banda ICC"], observed=True).agg(
+                **{
+                    "Parcelas": ("Población", "size"),
+                    "Población": ("Población", "sum"),
+                    "Suma vulnerabilidad": ("Vulnerabilidad", "sum"),
+                    "N vulnerabilidad": ("Vulnerabilidad", "count"),
+                    "Suma reducción": ("Reducción vulnerabilidad", "sum"),
+                    "N reducción": ("Reducción vulnerabilidad", "count"),
+                }
+            ).reset_index()
+
+            agregado.insert(0, "Estación", estacion)
+            agregado.insert(0, "Escenario", escenario)
+            piezas.append(agregado)
 
+    cubo = pd.concat(piezas, ignore_index=True)
+    cubo["Banda ICC"] = cubo["Banda ICC"].astype(str)
+    # Límite inferior de la banda, para responder consultas "ICC ≥ umbral"
+    cubo["ICC desde"] = cubo["Banda ICC"].map(desde).astype(float)
+    return cubo
+
+
+def media_ponderada(cubo, por, suma, n):
+    agregado = cubo.groupby(por)[[suma, n]].sum()
+    return agregado[suma] / agregado[n].where(agregado[n] > 0)
+
+
+# =========================
+# EXPOSICIÓN A VEGETACIÓN – ÍNDICE DE PROXIMIDAD
+# =========================
+INDICADORES_EXPOSICION = [
+    "Distancia a la zona verde más cercana",
+    "Árboles propuestos en un radio",
+    "Área verde propuesta en un radio",
+]
+
+
+def radios_proximidad():
+    return get_registry().config.get("radios_proximidad_m", list(RADIOS_PROXIMIDAD))
+
+
+CAPAS_PROXIMIDAD = ("parcelas", "zonas_verdes", "arboles")
+
+
+@st.cache_data(max_entries=MAX_DISTRITOS_CACHE)
+def build_proximity_index(distrito_id, versiones, _futuros=None):
+    """
+    Índice parcela–vegetación del distrito, calculado una sola vez (ver `indice_proximidad`).
+
+    `versiones` son las de parcelas, zonas verdes y árboles, en ese orden.
+    """
+    registro = get_registry()
+    parcelas, zonas, arboles = [
+        registro.capa(distrito_id, clave, v, _futuros)
+        for clave, v in zip(CAPAS_PROXIMIDAD, versiones)
+    ]
+    return indice_proximidad(
+        parcelas,
+        zonas,
+        arboles,
+        crs=registro.distrito(distrito_id).get("crs_metrico", CRS_METRICO),
+        radios=radios_proximidad()
+    )
+
+
+def exposicion_col(indicador, escenario, radio):
+    if indicador == "Distancia a la zona verde más cercana":
+        return columna_distancia(escenario)
+    if indicador == "Árboles propuestos en un radio":
+        return columna_arboles(escenario, radio)
+    return columna_area(escenario, radio)
+
+
+# =========================
+# COMPARACIÓN DE ESCENARIOS – GEOMETRÍA COMPARTIDA
+# =========================
+VARIABLES_COMPARACION = ["Índice de Vulnerabilidad", "Índice de contaminación (ICC)"]
+
+
+@st.cache_data(max_entries=MAX_DISTRITOS_CACHE)
+def geometria_parcelas_geojson(distrito_id, version_parcelas, _futuros=None):
+    """GeoJSON solo con la geometría de las parcelas, en el orden de `gdf`."""
+    return load_data(distrito_id, version_parcelas, _futuros).geometry.to_json()
+
+
+def valores_comparacion(gdf, variable, escenario, estacion):
+    if variable == "Índice de contaminación (ICC)":
+        return icc_escenario(gdf, escenario, estacion).to_numpy(dtype=float)
+    return _numerica(gdf, vulnerabilidad_col(escenario, estacion)).to_numpy(dtype=float)
+
+
+def colores_vectoriales(valores, colormap):
+    """
+    Colores hex por parcela interpolando el colormap sobre todo el array.
+
+    Los valores fuera de [vmin, vmax] o sin dato quedan como None (parcela
+    transparente), igual que en `style_function`.
+    """
+    valores = np.asarray(valores, dtype=float)
+    indice = np.asarray(colormap.index, dtype=float)
+    paleta = np.asarray(colormap.colors, dtype=float)
+
+    canales = np.stack(
+        [np.interp(valores, indice, paleta[:, k]) for k in range(3)],
+        axis=1
+    )
+    canales = np.rint(np.clip(canales, 0, 1) * 255).astype(np.uint8)
+    visibles = np.isfinite(valores) & (valores >= colormap.vmin) & (valores <= colormap.vmax)
+
+    return [
+        "#%02x%02x%02x" % tuple(rgb) if visible else None
+        for rgb, visible in zip(canales.tolist(), visibles)
+    ]
+
+
+def _valores_json(valores):
+    return [None if not np.isfinite(v) else round(float(v), 2) for v in valores]
+
+
+def _leyenda(colormap):
+    return {
+        "colores": [
+            "#%02x%02x%02x" % tuple(int(round(v * 255)) for v in c[:3])
+            for c in colormap.colors
+        ],
+        "vmin": float(colormap.vmin),
+        "vmax": float(colormap.vmax),
+    }
+
+
+def capa_parcelas(nombre, valores, colormap):
+    return {
+        "nombre": nombre,
+        "colores": colores_vectoriales(valores, colormap),
+        "valores": _valores_json(valores),
+        "leyenda": _leyenda(colormap),
+    }
+
+
+# =========================
+# ANIMACIÓN ESTACIONAL – FOTOGRAMAS RASTER
+# =========================
+@st.cache_data(max_entries=MAX_DISTRITOS_CACHE)
+def icc_raster_frames(distrito_id, estaciones, versiones, _futuros=None):
+    """
+    Fotogramas PNG (data URI) de los rasters ICC con una escala común.
+
+    La escala se fija con el mínimo y máximo válidos de todas las estaciones
+    para que los fotogramas sean comparables entre sí. `versiones` va
+    alineada con `estaciones`.
+    """
+    registro = get_registry()
+    rasters = [
+        registro.capa(distrito_id, f"icc:{estacion}", v, _futuros)
+        for estacion, v in zip(estaciones, versiones)
+    ]
+
+    validos = [data[icc_valid_mask(data)] for data, _, _ in rasters]
+    validos = [v for v in validos if v.size]
+    if not validos:
+        return [], None
+
+    vmin = float(min(v.min() for v in validos))
+    vmax = float(max(v.max() for v in validos))
+
+    fotogramas = []
+    for estacion, (data, bounds, _) in zip(estaciones, rasters):
+        buffer = io.BytesIO()
+        plt.imsave(buffer, icc_rgba(data, vmin, vmax), format="png")
+        fotogramas.append({
+            "nombre": estacion,
+            "png": "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii"),
+            "bounds": bounds,
+        })
+
+    leyenda = {"colores": ["rgba(255, 0, 0, 0)", "#ff0000"], "vmin": vmin, "vmax": vmax}
+    return fotogramas, leyenda
+
+
+HTML_CAPAS_PARCELAS = """
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+  body { margin: 0; font-family: sans-serif; }
+  #contenedor { display: flex; gap: 6px; height: __ALTO__px; }
+  .panel { position: relative; flex: 1; }
+  .mapa { width: 100%; height: 100%; background: #f5f5f5; }
+  .control {
+    position: absolute; top: 8px; left: 50px; z-index: 1000;
+    background: white; padding: 4px 6px; border-radius: 4px; font-size: 13px;
+  }
+  .leyenda {
+    position: absolute; bottom: 18px; right: 8px; z-index: 1000;
+    background: white; padding: 4px 6px; border-radius: 4px; font-size: 12px; width: 180px;
+  }
+  .leyenda .barra { height: 10px; margin: 2px 0; }
+  .leyenda .extremos { display: flex; justify-content: space-between; }
+  #cortinilla {
+    position: absolute; bottom: 8px; left: 10%; width: 80%; z-index: 1000;
+  }
+</style>
+<div id="contenedor"></div>
+<script>
+const GEOM = __GEOMETRIA__;
+const CAPAS = __CAPAS__;
+const FOTOGRAMAS = __FOTOGRAMAS__;
+const LEYENDA_RASTER = __LEYENDA_RASTER__;
+const VISTA = "__VISTA__";
+const CENTRO = __CENTRO__;
+const INTERVALO = __INTERVALO__;
+
+GEOM.features.forEach((f, i) => { f.properties = {i: i}; });
+
+function estilo(k) {
+  const colores = CAPAS[k].colores;
+  return f => {
+    const c = colores[f.properties.i];
+    if (c === null) { return {fillOpacity: 0, weight: 0}; }
+    return {fill: true, fillColor: c, color: "#333333", weight: 0.3, fillOpacity: 0.8};
+  };
+}
+
+function textoParcela(i) {
+  return CAPAS.map(c => "<b>" + c.nombre + ":</b> " +
+    (c.valores[i] === null ? "sin dato" : c.valores[i])).join("<br>");
+}
+
+function leyenda(div, nombre, l) {
+  div.innerHTML += "<div>" + nombre + "</div>" +
+    "<div class='barra' style='background: linear-gradient(to right, " + l.colores.join(",") + ")'></div>" +
+    "<div class='extremos'><span>" + l.vmin.toFixed(1) + "</span><span>" + l.vmax.toFixed(1) + "</span></div>";
+}
+
+function crearMapa(panel) {
+  const div = document.createElement("div");
+  div.className = "mapa";
+  panel.appendChild(div);
+  const mapa = L.map(div).setView(CENTRO, 16);
+  L.tileLayer("https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png", {
+    attribution: "&copy; OpenStreetMap &copy; CARTO", maxZoom: 20
+  }).addTo(mapa);
+  return mapa;
+}
+
+function capaParcelas(mapa, k, pane) {
+  const opciones = {
+    style: estilo(k),
+    onEachFeature: (f, layer) => layer.bindTooltip(() => textoParcela(f.properties.i), {sticky: true})
+  };
+  if (pane) {
+    opciones.pane = pane;
+    opciones.renderer = L.svg({pane: pane});
+  }
+  return L.geoJSON(GEOM, opciones).addTo(mapa);
+}
+
+function crearControl(panel) {
+  const control = document.createElement("div");
+  control.className = "control";
+  panel.appendChild(control);
+  L.DomEvent.disableClickPropagation(control);
+  return control;
+}
+
+function crearLeyenda(panel) {
+  const div = document.createElement("div");
+  div.className = "leyenda";
+  panel.appendChild(div);
+  return div;
+}
+
+function selectorCapa(panel, inicial, alCambiar) {
+  const select = document.createElement("select");
+  CAPAS.forEach((c, k) => {
+    const opt = document.createElement("option");
+    opt.value = k; opt.text = c.nombre; opt.selected = (k === inicial);
+    select.appendChild(opt);
+  });
+  select.onchange = () => alCambiar(parseInt(select.value));
+  crearControl(panel).appendChild(select);
+}
+
+function nuevoPanel() {
+  const panel = document.createElement("div");
+  panel.className = "panel";
+  document.getElementById("contenedor").appendChild(panel);
+  return panel;
+}
+
+if (VISTA === "lado") {
+  const mapas = [0, 1].map(k => {
+    const panel = nuevoPanel();
+    const mapa = crearMapa(panel);
+    const capa = capaParcelas(mapa, k);
+    const divLeyenda = crearLeyenda(panel);
+    selectorCapa(panel, k, nueva => {
+      capa.setStyle(estilo(nueva));
+      divLeyenda.innerHTML = "";
+      leyenda(divLeyenda, CAPAS[nueva].nombre, CAPAS[nueva].leyenda);
+    });
+    leyenda(divLeyenda, CAPAS[k].nombre, CAPAS[k].leyenda);
+    return mapa;
+  });
+
+  // Sincronización de vistas
+  let sincronizando = false;
+  mapas.forEach((mapa, k) => {
+    mapa.on("move", () => {
+      if (sincronizando) { return; }
+      sincronizando = true;
+      mapas[1 - k].setView(mapa.getCenter(), mapa.getZoom(), {animate: false});
+      sincronizando = false;
+    });
+  });
+} else if (VISTA === "cortinilla") {
+  const panel = nuevoPanel();
+  const mapa = crearMapa(panel);
+  mapa.createPane("izquierda");
+  mapa.createPane("derecha");
+  capaParcelas(mapa, 0, "izquierda");
+  const capaDer = capaParcelas(mapa, 1, "derecha");
+
+  const divLeyenda = crearLeyenda(panel);
+  selectorCapa(panel, 1, nueva => {
+    capaDer.setStyle(estilo(nueva));
+    divLeyenda.innerHTML = "";
+    leyenda(divLeyenda, CAPAS[nueva].nombre, CAPAS[nueva].leyenda);
+  });
+  leyenda(divLeyenda, CAPAS[1].nombre, CAPAS[1].leyenda);
+
+  const slider = document.createElement("input");
+  slider.type = "range"; slider.min = 0; slider.max = 1; slider.step = 0.001; slider.value = 0.5;
+  slider.id = "cortinilla";
+  panel.appendChild(slider);
+  L.DomEvent.disableClickPropagation(slider);
+
+  function recortar() {
+    const nw = mapa.containerPointToLayerPoint([0, 0]);
+    const se = mapa.containerPointToLayerPoint(mapa.getSize());
+    const x = mapa.containerPointToLayerPoint([mapa.getSize().x * slider.value, 0]).x;
+    mapa.getPane("izquierda").style.clip = "rect(" + [nw.y, x, se.y, nw.x].join("px,") + "px)";
+    mapa.getPane("derecha").style.clip = "rect(" + [nw.y, se.x, se.y, x].join("px,") + "px)";
+  }
+  slider.addEventListener("input", recortar);
+  mapa.on("move", recortar);
+  recortar();
+} else {
+  // Animación: todas las estaciones ya están en el navegador. Parcelas y
+  // fotogramas se emparejan por nombre de estación: una estación sin raster
+  // (o que aún se está cargando) oculta la imagen en lugar de desfasarla.
+  const panel = nuevoPanel();
+  const mapa = crearMapa(panel);
+  const capaDe = {};
+  CAPAS.forEach((c, k) => { capaDe[c.nombre] = k; });
+  const fotogramaDe = {};
+  FOTOGRAMAS.forEach(f => { fotogramaDe[f.nombre] = f; });
+  const nombres = CAPAS.map(c => c.nombre)
+    .concat(FOTOGRAMAS.map(f => f.nombre).filter(nombre => !(nombre in capaDe)));
+  const n = nombres.length;
+
+  const overlay = FOTOGRAMAS.length
+    ? L.imageOverlay(FOTOGRAMAS[0].png, FOTOGRAMAS[0].bounds).addTo(mapa)
+    : null;
+  const capa = CAPAS.length ? capaParcelas(mapa, 0) : null;
+
+  const divLeyenda = crearLeyenda(panel);
+  if (CAPAS.length) { leyenda(divLeyenda, "Parcelas", CAPAS[0].leyenda); }
+  if (LEYENDA_RASTER) { leyenda(divLeyenda, "ICC a nivel de calle", LEYENDA_RASTER); }
+
+  const control = crearControl(panel);
+  const boton = document.createElement("button");
+  const slider = document.createElement("input");
+  slider.type = "range"; slider.min = 0; slider.max = n - 1; slider.step = 1; slider.value = 0;
+  const etiqueta = document.createElement("b");
+  control.append(boton, " ", slider, " ", etiqueta);
+
+  function mostrar(k) {
+    const nombre = nombres[k];
+    if (capa) {
+      capa.setStyle(nombre in capaDe ? estilo(capaDe[nombre]) : {fillOpacity: 0, weight: 0});
+    }
+    if (overlay) {
+      const fotograma = fotogramaDe[nombre];
+      if (fotograma) {
+        overlay.setUrl(fotograma.png);
+        overlay.setBounds(L.latLngBounds(fotograma.bounds));
+      }
+      overlay.setOpacity(fotograma ? 1 : 0);
+    }
+    etiqueta.textContent = nombre;
+    slider.value = k;
+  }
+
+  let actual = 0;
+  let temporizador = null;
+  function pausar() {
+    clearInterval(temporizador);
+    temporizador = null;
+    boton.textContent = "▶";
+  }
+  boton.onclick = () => {
+    if (temporizador) { pausar(); return; }
+    boton.textContent = "⏸";
+    temporizador = setInterval(() => { actual = (actual + 1) % n; mostrar(actual); }, INTERVALO);
+  };
+  slider.addEventListener("input", () => { pausar(); actual = parseInt(slider.value); mostrar(actual); });
+
+  pausar();
+  mostrar(0);
+}
+</script>
+"""
+
+GEOMETRIA_VACIA = '{"type": "FeatureCollection", "features": []}'
+
+
+def html_capas_parcelas(
+    geometria,
+    capas,
+    vista,
+    centro,
+    fotogramas=None,
+    leyenda_raster=None,
+    intervalo=1200,
+    alto=650
+):
+    """
+    Componente Leaflet con una sola copia de la geometría de las parcelas.
+
+    Cada capa (escenario, diferencia o estación) aporta solo su array de
+    colores y valores, y los fotogramas raster viajan como PNG ya
+    codificados; cambiar de capa, mover la cortinilla o avanzar la
+    animación se resuelve en el navegador sin rerun de Streamlit.
+    """
+    return (
+        HTML_CAPAS_PARCELAS
+        .replace("__ALTO__", str(alto))
+        .replace("__GEOMETRIA__", geometria)
+        .replace("__CAPAS__", json.dumps(capas))
+        .replace("__FOTOGRAMAS__", json.dumps(fotogramas or []))
+        .replace("__LEYENDA_RASTER__", json.dumps(leyenda_raster))
+        .replace("__VISTA__", vista)
+        .replace("__CENTRO__", json.dumps(centro))
+        .replace("__INTERVALO__", str(int(intervalo)))
+    )
+
+
+# =========================
+# RECARGA EN CALIENTE
+# =========================
+def precalcular_derivados(distrito_id, futuros_nuevos, cambiadas):
+    """
+    Rellena las cachés derivadas con la nueva versión de las capas cambiadas.
+
+    Lo llama el registro en segundo plano antes de publicar la recarga, así
+    que la primera sesión que ve los datos nuevos ya los encuentra calculados
+    y solo se rehacen los derivados que dependen de esas capas.
+    """
+    cambiadas = set(cambiadas)
+
+    if "parcelas" in cambiadas:
+        version_parcelas = version(futuros_nuevos, "parcelas")
+        build_summary_cube(distrito_id, version_parcelas, futuros_nuevos)
+        geometria_parcelas_geojson(distrito_id, version_parcelas, futuros_nuevos)
+
+    if cambiadas & set(CAPAS_PROXIMIDAD) and not any(
+        capa_fallida(futuros_nuevos[clave]) for clave in CAPAS_PROXIMIDAD
+    ):
+        build_proximity_index(
+            distrito_id,
+            tuple(version(futuros_nuevos, clave) for clave in CAPAS_PROXIMIDAD),
+            futuros_nuevos
+        )
+
+    if any(clave.startswith("icc:") for clave in cambiadas):
+        estaciones = tuple(
+            e for e in ESTACIONES
+            if e in futuros_nuevos["icc"] and not capa_fallida(futuros_nuevos["icc"][e])
+        )
+        icc_raster_frames(
+            distrito_id,
+            estaciones,
+            tuple(version(futuros_nuevos, f"icc:{e}") for e in estaciones),
+            futuros_nuevos
+        )
+
+
+@st.cache_resource
+def activar_recarga_en_caliente():
+    """Una vez por proceso: precálculo de derivados y vigilancia de ficheros."""
+    registro = get_registry()
+    registro.al_recargar(precalcular_derivados)
+    registro.vigilar()
+    return True
+
+
+activar_recarga_en_caliente()
 
 
 # =========================
@@ -274,7 +919,13 @@ st.sidebar.header("MODO DEL VISOR")
 
 modo = st.sidebar.radio(
     "Selecciona modo",
-    ["Simulación de escenarios", "Demografía y Catastro"]
+    [
+        "Simulación de escenarios",
+        "Comparación de escenarios",
+        "Animación estacional",
+        "Resumen del barrio",
+        "Demografía y Catastro"
+    ]
 )
 
 # ============================================================
@@ -306,7 +957,8 @@ if modo == "Simulación de escenarios":
             [
                 "Reducción del índice de contaminación (ICC)",
                 "Reducción del índice de Vulnerabilidad",
-                "Índice de Vulnerabilidad"
+                "Índice de Vulnerabilidad",
+                "Exposición a vegetación propuesta"
             ]
         )
 
@@ -330,6 +982,18 @@ if modo == "Simulación de escenarios":
             ["Invierno", "Primavera", "Verano", "Otoño", "Media anual"]
         )
 
+    # =========================
+    # SELECTOR DE INDICADOR DE EXPOSICIÓN
+    # =========================
+    indicador = radio = None
+    if variable == "Exposición a vegetación propuesta":
+        indicador = st.sidebar.selectbox("Indicador", INDICADORES_EXPOSICION)
+        if indicador != "Distancia a la zona verde más cercana":
+            radio = st.sidebar.selectbox(
+                "Radio (m)",
+                radios_proximidad(),
+                index=len(radios_proximidad()) // 2
+            )
 
 
     # 👉 NUEVO: ajuste manual opcional
@@ -345,22 +1009,31 @@ if modo == "Simulación de escenarios":
         col = ICC_ACTUAL_COLS[estacion]
 
     elif escenario == "Actual":
-        col = f"Índice de Vulnerabilidad en {estacion} en el escenario Actual (0-100)"
+        col = vulnerabilidad_col("Actual", estacion)
 
     elif variable == "Reducción del índice de contaminación (ICC)":
-        col = (
-            "ESCENARIO 1: Porcentaje de reducción del índice de contaminación (ICC) en escenario Ideal (0-100)"
-            if escenario == "Ideal"
-            else
-            "ESCENARIO 2: Porcentaje de reducción del índice de contaminación (ICC) en escenario Prioritario (0-100)"
-        )
+        col = REDUCCION_ICC_COLS[escenario]
 
     elif variable == "Reducción del índice de Vulnerabilidad":
         col = REDUCCION_VULNERABILIDAD_COLS[escenario][estacion]
 
+    elif variable == "Exposición a vegetación propuesta":
+        col = exposicion_col(indicador, escenario, radio)
 
     else:
-        col = f"Índice de Vulnerabilidad en {estacion} en el escenario {escenario} (0-100)"
+        col = vulnerabilidad_col(escenario, estacion)
+
+    proximidad = None
+    if variable == "Exposición a vegetación propuesta":
+        esperar_capa(futuros["parcelas"], "las parcelas")
+        esperar_capa(futuros["zonas_verdes"], "las nuevas zonas verdes")
+        esperar_capa(futuros["arboles"], "los árboles propuestos")
+        with st.spinner("Calculando proximidad a la vegetación…"):
+            proximidad = build_proximity_index(
+                distrito_id,
+                tuple(version(futuros, clave) for clave in CAPAS_PROXIMIDAD),
+                futuros
+            )
 
     # =========================
     # RANGO BASE (FIJO)
@@ -374,6 +1047,12 @@ if modo == "Simulación de escenarios":
     
     elif variable == "Reducción del índice de Vulnerabilidad":
         vmin, vmax = RANGO_REDICCION_VULNERABILIDAD
+
+    elif variable == "Exposición a vegetación propuesta":
+        # Escala según los datos (metros, nº de árboles o m²)
+        vmin = 0.0
+        vmax = float(np.nanmax(proximidad[col].to_numpy(dtype=float), initial=0.0))
+        vmax = max(vmax, 1.0)
     
     else:
         # Índice de Vulnerabilidad (Actual / Ideal / Prioritario)
@@ -386,10 +1065,12 @@ if modo == "Simulación de escenarios":
     if ajustar_rango:
         st.sidebar.markdown("**Escala manual**")
 
+        max_manual = max(100.0, float(vmax))
+
         vmin = st.sidebar.number_input(
             "Valor mínimo",
             min_value=0.0,
-            max_value=100.0,
+            max_value=max_manual,
             value=vmin,
             step=1.0
         )
@@ -397,7 +1078,7 @@ if modo == "Simulación de escenarios":
         vmax = st.sidebar.number_input(
             "Valor máximo",
             min_value=0.0,
-            max_value=100.0,
+            max_value=max_manual,
             value=vmax,
             step=1.0
         )
@@ -436,6 +1117,14 @@ if modo == "Simulación de escenarios":
                 vmin=vmin,
                 vmax=vmax
             )
+
+        elif indicador == "Distancia a la zona verde más cercana":
+            # Distancia (más cerca = mejor)
+            colormap = cm.LinearColormap(
+                list(reversed(cm.linear.Greens_09.colors)),
+                vmin=vmin,
+                vmax=vmax
+            )
     
         else:
             # Reducción del ICC (más = mejor)
@@ -451,6 +1140,11 @@ if modo == "Simulación de escenarios":
     # =========================
     # MAPA
     # =========================
+    gdf = esperar_capa(futuros["parcelas"], "las parcelas")
+
+    if proximidad is not None:
+        gdf = gdf.join(proximidad[[col]])
+
     center = gdf.geometry.centroid
     m = folium.Map(
         location=[center.y.mean(), center.x.mean()],
@@ -465,17 +1159,19 @@ if modo == "Simulación de escenarios":
     # =========================
     if escenario == "Actual" and variable == "ICC a nivel de calle":
     
-        raster_path = ICC_RASTERS.get(estacion)
+        futuro_raster = futuros["icc"].get(estacion)
     
-        if raster_path is None:
+        if futuro_raster is None:
             st.warning("No hay raster ICC para esta estación.")
         else:
-            add_icc_raster_to_map(
-                m,
-                raster_path,
-                layer_name=f"ICC {estacion} (nivel de calle)",
-                colormap="reds"
-            )
+            raster = capa_si_lista(futuro_raster, f"raster ICC {estacion}")
+            if raster is not None:
+                add_icc_raster_to_map(
+                    m,
+                    raster,
+                    layer_name=f"ICC {estacion} (nivel de calle)",
+                    colormap="reds"
+                )
         icc_min = 0
         icc_max = 60   # o el rango que hayas decidido
     
@@ -541,13 +1237,16 @@ if modo == "Simulación de escenarios":
     # =========================
     # VEGETACIÓN
     # =========================
-    if escenario == "Ideal":
-        zonas_plot, arboles_plot = zonas_verdes, arboles
-    elif escenario == "Prioritario":
-        zonas_plot = zonas_verdes[zonas_verdes["Prioridad"] == "1"]
-        arboles_plot = arboles[arboles["Prioridad"] == "1"]
-    else:
-        zonas_plot = arboles_plot = None
+    zonas_plot = arboles_plot = None
+    if escenario in ["Ideal", "Prioritario"]:
+        zonas_plot = capa_si_lista(futuros["zonas_verdes"], "nuevas zonas verdes")
+        arboles_plot = capa_si_lista(futuros["arboles"], "árboles propuestos")
+
+    if escenario == "Prioritario":
+        if zonas_plot is not None:
+            zonas_plot = zonas_plot[zonas_plot["Prioridad"] == "1"]
+        if arboles_plot is not None:
+            arboles_plot = arboles_plot[arboles_plot["Prioridad"] == "1"]
 
     if zonas_plot is not None and not zonas_plot.empty:
         folium.GeoJson(
@@ -611,6 +1310,9 @@ if modo == "Simulación de escenarios":
     elif variable == "Reducción del índice de contaminación (ICC)":
         st.info(TEXTO_REDUCCION_ICC)
 
+    elif variable == "Exposición a vegetación propuesta":
+        st.info(TEXTO_EXPOSICION_VEGETACION)
+
     # =========================
     # LAYOUT: MAPA + INFO
     # =========================
@@ -642,10 +1344,15 @@ if modo == "Simulación de escenarios":
         import rasterio
         from rasterio.warp import transform
     
-        raster_path = ICC_RASTERS.get(estacion)
+        futuro_raster = futuros["icc"].get(estacion)
     
-        if raster_path is not None:
-            data, raster_transform, raster_crs, height, width = load_icc_raster(raster_path)
+        if (
+            futuro_raster is not None
+            and futuro_raster.done()
+            and not capa_fallida(futuro_raster)
+        ):
+            # Banda original de la misma versión del raster que se está pintando
+            data, raster_transform, raster_crs, height, width = futuro_raster.result()[2]
             xs, ys = transform(
                 "EPSG:4326",
                 raster_crs,
@@ -678,7 +1385,311 @@ if modo == "Simulación de escenarios":
 
 
 # ============================================================
-# ============ MODO 2: DEMOGRAFÍA Y CATASTRO =================
+# ============= MODO 2: COMPARACIÓN DE ESCENARIOS ============
+# ============================================================
+elif modo == "Comparación de escenarios":
+
+    st.sidebar.header("COMPARACIÓN DE ESCENARIOS")
+
+    escenario_a = st.sidebar.selectbox("Escenario A", ESCENARIOS, index=0)
+    escenario_b = st.sidebar.selectbox("Escenario B", ESCENARIOS, index=1)
+
+    variable = st.sidebar.selectbox("Variable", VARIABLES_COMPARACION)
+
+    if variable == "Índice de contaminación (ICC)":
+        estacion = st.sidebar.selectbox("Estación", ESTACIONES + ["Media anual"])
+        vmin, vmax = 0.0, 50.0
+    else:
+        estacion = st.sidebar.selectbox("Estación", ESTACIONES)
+        vmin, vmax = RANGO_INDICE_VULNERABILIDAD
+
+    vista = st.sidebar.radio("Vista", ["Lado a lado", "Cortinilla"])
+
+    gdf = esperar_capa(futuros["parcelas"], "las parcelas")
+
+    valores_a = valores_comparacion(gdf, variable, escenario_a, estacion)
+    valores_b = valores_comparacion(gdf, variable, escenario_b, estacion)
+    diferencia = valores_b - valores_a
+
+    colormap = cm.LinearColormap(cm.linear.Reds_09.colors, vmin=vmin, vmax=vmax)
+
+    # Diferencia simétrica: verde si B reduce el valor, rojo si lo aumenta
+    limite = np.nanmax(np.abs(diferencia)) if np.isfinite(diferencia).any() else 0.0
+    limite = max(float(limite), 1.0)
+    colormap_dif = cm.LinearColormap(
+        ["#1a9850", "#f7f7f7", "#d73027"],
+        vmin=-limite,
+        vmax=limite
+    )
+
+    if variable == "Índice de contaminación (ICC)":
+        nombre_a, nombre_b = etiqueta_icc(escenario_a), etiqueta_icc(escenario_b)
+    else:
+        nombre_a, nombre_b = escenario_a, escenario_b
+
+    capas = [
+        capa_parcelas(f"A: {nombre_a}", valores_a, colormap),
+        capa_parcelas(f"B: {nombre_b}", valores_b, colormap),
+        capa_parcelas("Diferencia (B − A)", diferencia, colormap_dif),
+    ]
+
+    st.markdown(
+        f"## {variable} en {estacion}: {nombre_a} vs {nombre_b}"
+    )
+
+    center = gdf.geometry.centroid
+    components.html(
+        html_capas_parcelas(
+            geometria_parcelas_geojson(distrito_id, version(futuros, "parcelas"), futuros),
+            capas,
+            "lado" if vista == "Lado a lado" else "cortinilla",
+            [float(center.y.mean()), float(center.x.mean())]
+        ),
+        height=670
+    )
+
+    # =========================
+    # RESUMEN DE LA DIFERENCIA
+    # =========================
+    validas = np.isfinite(diferencia)
+    col_media, col_baja, col_sube = st.columns(3)
+    col_media.metric(
+        "Diferencia media (B − A)",
+        f"{np.nanmean(diferencia):.2f}" if validas.any() else "–"
+    )
+    col_baja.metric("Parcelas que reducen", int((diferencia[validas] < 0).sum()))
+    col_sube.metric("Parcelas que aumentan", int((diferencia[validas] > 0).sum()))
+
+    if variable == "Índice de Vulnerabilidad":
+        st.info(TEXTO_VULNERABILIDAD)
+    else:
+        st.info(TEXTO_ICC)
+        if escenario_a != "Actual" or escenario_b != "Actual":
+            st.info(TEXTO_ICC_ESTIMADO)
+
+
+# ============================================================
+# ============== MODO 3: ANIMACIÓN ESTACIONAL ================
+# ============================================================
+elif modo == "Animación estacional":
+
+    st.sidebar.header("ANIMACIÓN ESTACIONAL")
+
+    escenario = st.sidebar.selectbox("Escenario", ESCENARIOS)
+    variable = st.sidebar.selectbox("Variable", VARIABLES_COMPARACION)
+
+    # Los rasters ICC a nivel de calle solo existen para el escenario actual
+    if escenario == "Actual":
+        capas_anim = st.sidebar.radio(
+            "Capas",
+            ["Parcelas", "ICC a nivel de calle", "Parcelas + ICC a nivel de calle"]
+        )
+    else:
+        capas_anim = "Parcelas"
+
+    segundos = st.sidebar.slider(
+        "Segundos por estación",
+        min_value=0.5,
+        max_value=5.0,
+        value=1.5,
+        step=0.5
+    )
+
+    mostrar_parcelas = capas_anim != "ICC a nivel de calle"
+    mostrar_raster = capas_anim != "Parcelas"
+
+    if variable == "Índice de contaminación (ICC)":
+        vmin, vmax = 0.0, 50.0
+    else:
+        vmin, vmax = RANGO_INDICE_VULNERABILIDAD
+    colormap = cm.LinearColormap(cm.linear.Reds_09.colors, vmin=vmin, vmax=vmax)
+
+    gdf = esperar_capa(futuros["parcelas"], "las parcelas")
+
+    capas = []
+    if mostrar_parcelas:
+        capas = [
+            capa_parcelas(
+                estacion,
+                valores_comparacion(gdf, variable, escenario, estacion),
+                colormap
+            )
+            for estacion in ESTACIONES
+        ]
+
+    fotogramas, leyenda_raster = [], None
+    if mostrar_raster:
+        estaciones_raster = tuple(e for e in ESTACIONES if e in futuros["icc"])
+        pendientes = [
+            futuros["icc"][e] for e in estaciones_raster if not futuros["icc"][e].done()
+        ]
+
+        if pendientes and mostrar_parcelas:
+            # Se anima ya con las parcelas y los fotogramas se añaden al terminar
+            CAPAS_PENDIENTES.extend(pendientes)
+            st.caption("⏳ Cargando rasters ICC…")
+        else:
+            if pendientes:
+                with st.spinner("Cargando rasters ICC…"):
+                    wait(pendientes)
+            fallidas = [e for e in estaciones_raster if capa_fallida(futuros["icc"][e])]
+            if fallidas:
+                st.warning(
+                    f"No se han podido cargar los rasters ICC de: {', '.join(fallidas)}. "
+                    "Se reintentará en unos segundos."
+                )
+                CAPAS_FALLIDAS.extend(futuros["icc"][e] for e in fallidas)
+            estaciones_raster = tuple(e for e in estaciones_raster if e not in fallidas)
+            fotogramas, leyenda_raster = icc_raster_frames(
+                distrito_id,
+                estaciones_raster,
+                tuple(version(futuros, f"icc:{e}") for e in estaciones_raster),
+                futuros
+            )
+
+        if not fotogramas and not pendientes:
+            st.warning("Raster sin valores válidos")
+            if not mostrar_parcelas:
+                if CAPAS_FALLIDAS:
+                    sondear_y_relanzar()
+                st.stop()
+
+    nombre_escenario = etiqueta_icc(escenario) if variable == "Índice de contaminación (ICC)" else escenario
+    st.markdown(f"## {variable} a lo largo del año – escenario {nombre_escenario}")
+
+    center = gdf.geometry.centroid
+    components.html(
+        html_capas_parcelas(
+            geometria_parcelas_geojson(distrito_id, version(futuros, "parcelas"), futuros)
+            if mostrar_parcelas else GEOMETRIA_VACIA,
+            capas,
+            "animacion",
+            [float(center.y.mean()), float(center.x.mean())],
+            fotogramas=fotogramas,
+            leyenda_raster=leyenda_raster,
+            intervalo=segundos * 1000
+        ),
+        height=670
+    )
+
+    if mostrar_parcelas and variable == "Índice de Vulnerabilidad":
+        st.info(TEXTO_VULNERABILIDAD)
+    else:
+        st.info(TEXTO_ICC)
+        if escenario != "Actual":
+            st.info(TEXTO_ICC_ESTIMADO)
+
+
+# ============================================================
+# ================ MODO 4: RESUMEN DEL BARRIO ================
+# ============================================================
+elif modo == "Resumen del barrio":
+
+    st.sidebar.header("RESUMEN DEL BARRIO")
+
+    estacion = st.sidebar.selectbox("Estación", ESTACIONES)
+
+    escenarios_sel = st.sidebar.multiselect(
+        "Escenarios",
+        ESCENARIOS,
+        default=ESCENARIOS
+    )
+
+    umbral_icc = st.sidebar.select_slider(
+        "Umbral ICC (población expuesta con ICC ≥ umbral)",
+        options=BANDAS_ICC[:-1],
+        value=30
+    )
+
+    if not escenarios_sel:
+        st.warning("Selecciona al menos un escenario.")
+        st.stop()
+
+    esperar_capa(futuros["parcelas"], "las parcelas")
+    cubo = build_summary_cube(distrito_id, version(futuros, "parcelas"), futuros)
+
+    cubo_sel = cubo[
+        (cubo["Estación"] == estacion)
+        & cubo["Escenario"].isin(escenarios_sel)
+    ]
+    expuestos = cubo_sel[cubo_sel["ICC desde"] >= umbral_icc]
+
+    st.markdown(f"## Resumen del barrio – {estacion}")
+
+    # =========================
+    # POBLACIÓN EXPUESTA POR ESCENARIO
+    # =========================
+    st.markdown(f"### Población expuesta a ICC ≥ {umbral_icc}")
+
+    poblacion_expuesta = (
+        expuestos.groupby("Escenario")["Población"].sum()
+        .reindex(escenarios_sel, fill_value=0.0)
+    )
+    referencia = poblacion_expuesta.get("Actual")
+
+    for col_metric, (esc, total) in zip(
+        st.columns(len(escenarios_sel)), poblacion_expuesta.items()
+    ):
+        delta = None
+        if referencia is not None and esc != "Actual":
+            delta = f"{total - referencia:,.0f}"
+        col_metric.metric(etiqueta_icc(esc), f"{total:,.0f}", delta=delta, delta_color="inverse")
+
+    st.dataframe(
+        expuestos.pivot_table(
+            index="USO",
+            columns="Escenario",
+            values="Población",
+            aggfunc="sum",
+            fill_value=0.0
+        ).reindex(columns=escenarios_sel, fill_value=0.0).round(0).rename(columns=etiqueta_icc),
+        use_container_width=True
+    )
+
+    # =========================
+    # VULNERABILIDAD POR USO
+    # =========================
+    col_vuln, col_red = st.columns(2)
+
+    with col_vuln:
+        st.markdown("### Índice de Vulnerabilidad medio por USO")
+        vuln_uso = media_ponderada(
+            cubo_sel, ["USO", "Escenario"], "Suma vulnerabilidad", "N vulnerabilidad"
+        ).unstack("Escenario").reindex(columns=escenarios_sel)
+        st.bar_chart(vuln_uso)
+
+    with col_red:
+        st.markdown("### Reducción media de la vulnerabilidad por USO (%)")
+        cubo_red = cubo_sel[cubo_sel["Escenario"] != "Actual"]
+        if cubo_red.empty:
+            st.info("Selecciona el escenario Ideal o Prioritario.")
+        else:
+            red_uso = media_ponderada(
+                cubo_red, ["USO", "Escenario"], "Suma reducción", "N reducción"
+            ).unstack("Escenario")
+            st.bar_chart(red_uso)
+
+    # =========================
+    # DISTRIBUCIÓN POR BANDAS ICC
+    # =========================
+    st.markdown("### Población por banda de ICC")
+    st.bar_chart(
+        cubo_sel.pivot_table(
+            index="Banda ICC",
+            columns="Escenario",
+            values="Población",
+            aggfunc="sum",
+            fill_value=0.0
+        ).reindex(ETIQUETAS_BANDAS_ICC + [SIN_DATO]).dropna(how="all").rename(columns=etiqueta_icc)
+    )
+
+    st.info(TEXTO_ICC)
+    if any(esc != "Actual" for esc in escenarios_sel):
+        st.info(TEXTO_ICC_ESTIMADO)
+
+
+# ============================================================
+# ============ MODO 5: DEMOGRAFÍA Y CATASTRO =================
 # ============================================================
 else:
 
@@ -699,6 +1710,8 @@ else:
         "Tipología del edificio (uso)": "USO"
     }
 
+    gdf = esperar_capa(futuros["parcelas"], "las parcelas")
+
     demog_vars = {k: v for k, v in demog_vars.items() if v in gdf.columns}
 
     var_label = st.sidebar.selectbox(
@@ -812,49 +1825,10 @@ else:
     )
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+# =========================
+# CAPAS EN CARGA
+# =========================
+# Se relanza el script para que las capas pendientes o reintentadas
+# aparezcan sin que el usuario tenga que interactuar.
+if CAPAS_PENDIENTES or CAPAS_FALLIDAS:
+    sondear_y_relanzar()